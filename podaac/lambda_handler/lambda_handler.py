@@ -1,13 +1,20 @@
 """lambda function used for image generation in aws lambda with cumulus"""
 
+import functools
+import hashlib
 import json
 import logging
 import os
 import re
+import tempfile
+import time
+from collections import deque
 from shutil import rmtree
 import multiprocessing as mp
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+import requests.adapters
 
 import botocore
 from cumulus_logger import CumulusLogger
@@ -17,15 +24,35 @@ from podaac.lambda_handler.cumulus_cli_handler.handlers import activity
 
 cumulus_logger = CumulusLogger('image_generator')
 
+# Scratch folder of the Lambda, emptied by clean_tmp
+TEMP_DIR = '/tmp'
+
+# Configs and palettes fetched by earlier invocations of a warm container, kept by clean_tmp
+CACHE_DIR = os.environ.get('TIG_CACHE_DIR') or os.path.join(TEMP_DIR, 'tig-cache')
+
+
+def init():
+    """Warms up the container once, outside of the handler, by importing the
+    rendering modules and loading the matplotlib font cache. Variable processes
+    are forked from this process so they start warm. Returns the seconds spent
+    in each step, which are logged to track cold start regressions."""
+    start = time.perf_counter()
+    timings = tig.prewarm()
+    timings['total'] = round(time.perf_counter() - start, 3)
+    cumulus_logger.info(json.dumps({'init_seconds': timings}))
+    return timings
+
 
 def clean_tmp(remove_matlibplot=True):
-    """ Deletes everything in /tmp """
-    temp_folder = '/tmp'
+    """ Deletes everything in TEMP_DIR """
+    temp_folder = TEMP_DIR
     temp_files = os.listdir(temp_folder)
 
     cumulus_logger.info("Removing everything in tmp folder {}".format(temp_files))
     for filename in os.listdir(temp_folder):
         file_path = os.path.join(temp_folder, filename)
+        if os.path.abspath(file_path) == os.path.abspath(CACHE_DIR):
+            continue
         try:
             if os.path.isfile(file_path) or os.path.islink(file_path):
                 os.unlink(file_path)
@@ -42,15 +69,169 @@ def clean_tmp(remove_matlibplot=True):
     cumulus_logger.info("After Removing everything in tmp folder {}".format(temp_files))
 
 
-def generate_images(local_file, path, config_file, palette_dir, granule_id, variables, logger, conn):
-    """Function to call in multiprocess to generate images"""
+def get_process_count(n_variables):
+    """Number of processes used to render variables, from the TIG_PROCESSES
+    environment variable or else the number of available cpus, never more
+    than the number of variables"""
+    processes = os.environ.get('TIG_PROCESSES')
+    if processes:
+        count = int(processes)
+    elif hasattr(os, 'sched_getaffinity'):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = os.cpu_count() or 1
+    return max(1, min(count, n_variables))
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session():
+    """Session shared by every request of the process, it keeps connections
+    to the config and palette servers open across invocations"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_cache():
+    """Cache of configs and palettes shared by every invocation of the process"""
+    return RemoteFileCache(CACHE_DIR, float(os.environ.get('TIG_CACHE_TTL') or 300))
+
+
+class RemoteFileCache():
+    """
+    Files fetched from URLs or S3, kept in memory and on disk so warm
+    invocations reuse them. Files fetched less than ttl seconds ago are used
+    as is, older ones are revalidated with their ETag and Last-Modified and
+    only fetched again when they changed.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        # (metadata, content) keyed by URL
+        self._entries = {}
+
+    def _paths(self, url):
+        name = hashlib.sha256(url.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f'{name}.json'), os.path.join(self.directory, f'{name}.data')
+
+    def _load(self, url):
+        """Returns the cached (metadata, content) of a URL, None when it isn't cached"""
+        if url not in self._entries:
+            metadata_path, data_path = self._paths(url)
+            try:
+                with open(metadata_path) as metadata_file, open(data_path, 'rb') as data_file:
+                    self._entries[url] = (json.load(metadata_file), data_file.read())
+            except (OSError, ValueError):
+                return None
+        return self._entries[url]
+
+    def _store(self, url, metadata, content):
+        """Keeps a fetched file in memory and on disk, writes are atomic so readers never see partial files"""
+        self._entries[url] = (metadata, content)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            metadata_path, data_path = self._paths(url)
+            for path, data in ((data_path, content), (metadata_path, json.dumps(metadata).encode())):
+                with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as temp_file:
+                    temp_file.write(data)
+                os.replace(temp_file.name, path)
+        except OSError as ex:
+            cumulus_logger.warning("Could not cache {}: {}".format(url, ex))
+
+    def _fresh(self, url):
+        """Returns the cached (metadata, content) of a URL and whether it is younger than the ttl"""
+        entry = self._load(url)
+        if entry is None:
+            return None, False
+        return entry, time.time() - entry[0]['fetched'] < self.ttl
+
+    def fetch_url(self, url):
+        """Returns the content of a URL fetched with the shared HTTP session"""
+        entry, fresh = self._fresh(url)
+        if fresh:
+            return entry[1]
+
+        headers = {}
+        if entry is not None:
+            if entry[0].get('etag'):
+                headers['If-None-Match'] = entry[0]['etag']
+            if entry[0].get('last_modified'):
+                headers['If-Modified-Since'] = entry[0]['last_modified']
+        response = get_http_session().get(url, headers=headers, timeout=60)
+        if entry is not None and response.status_code == 304:
+            metadata, content = entry
+        else:
+            if response.status_code >= 400:
+                response.raise_for_status()
+            metadata = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            content = response.content
+        self._store(url, dict(metadata, fetched=time.time()), content)
+        return content
+
+    def fetch_s3(self, uri, client):
+        """Returns the content of an S3 object"""
+        entry, fresh = self._fresh(uri)
+        if fresh:
+            return entry[1]
+
+        s3_uri = s3.uri_parser(uri)
+        conditions = {}
+        if entry is not None and entry[0].get('etag'):
+            conditions['IfNoneMatch'] = entry[0]['etag']
+        try:
+            response = client.get_object(Bucket=s3_uri['bucket'], Key=s3_uri['key'], **conditions)
+            metadata = {'etag': response.get('ETag')}
+            content = response['Body'].read()
+        except botocore.exceptions.ClientError as ex:
+            if entry is None or ex.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                raise
+            metadata, content = entry
+        self._store(uri, dict(metadata, fetched=time.time()), content)
+        return content
+
+
+def get_upload_workers(n_images=None):
+    """Number of threads uploading images, from the TIG_UPLOAD_WORKERS
+    environment variable or else 8, never more than the number of images"""
+    count = int(os.environ.get('TIG_UPLOAD_WORKERS') or 8)
+    if n_images is not None:
+        count = min(count, n_images)
+    return max(1, count)
+
+
+def get_prefetch_count():
+    """Number of input files fetched ahead of the one being rendered, from the
+    TIG_PREFETCH environment variable or else 1, 0 fetches each file when it is rendered"""
+    return max(0, int(os.environ.get('TIG_PREFETCH') or 1))
+
+
+def partition_variables(variables, count):
+    """Splits the variables into count contiguous lists of nearly equal size"""
+    size, extra = divmod(len(variables), count)
+    partitions, start = [], 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        partitions.append(variables[start:end])
+        start = end
+    return partitions
+
+
+def generate_images(config_file, palette_dir, variables, logger, conn):
+    """Function to call in multiprocess to generate the images of variables for
+    every (local_file, path, granule_id) received on conn, until None is received"""
     try:
-        image_gen = tig.TIG(local_file, path, config_file, palette_dir, variables=variables, logger=logger)
-        images = image_gen.generate_images(granule_id=granule_id)
-        conn.send(({'status': 'success', 'data': images}, None))
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        conn.send(({'status': 'error', 'data': None}, (str(e), error_traceback)))
+        for local_file, path, granule_id in iter(conn.recv, None):
+            try:
+                image_gen = tig.TIG(local_file, path, config_file, palette_dir, variables=variables, logger=logger)
+                images = image_gen.generate_images(granule_id=granule_id)
+                conn.send(({'status': 'success', 'data': images}, None))
+            except Exception as e:
+                error_traceback = traceback.format_exc()
+                conn.send(({'status': 'error', 'data': None}, (str(e), error_traceback)))
     finally:
         conn.close()
 
@@ -82,8 +263,8 @@ class ImageGenerator(Process):
         main function ran for image generation
     generate_file_dictionary({file_data}, /user/test/test.png, test.png, [....], {....})
         creates the dictionary data for a generated image
-    image_generate({file_data}, "/tmp/configuration.cfg", "/tmp/palette_dir", "granule.nc" )
-        generates all images for a nc file
+    process_pipeline([(granule_id, {file_data}), ...], "/tmp/configuration.cfg")
+        generates and uploads all images for nc files
     get_config()
         downloads configuration file for tig
     download_file_from_s3('s3://my-internal-bucket/dataset-config/MODIS_A.2019.cfg', '/tmp/workspace')
@@ -95,11 +276,20 @@ class ImageGenerator(Process):
         self.processing_regex = '(.*\\.nc$)'
         super().__init__(*args, **kwargs)
         self.logger = cumulus_logger
+        # Shared by every upload, boto3 clients are thread safe and keep their connections open
+        self.s3_client = None
+
+    def get_s3_client(self):
+        """ Returns the S3 client of this process, creating it on first use """
+        if self.s3_client is None:
+            self.s3_client = tig.get_s3_client(max(10, get_upload_workers()))
+        return self.s3_client
 
     def clean_all(self):
         """ Removes anything saved to self.path """
         rmtree(self.path)
-        clean_tmp()
+        # Keep the matplotlib font cache for the next invocation of a warm container
+        clean_tmp(remove_matlibplot=False)
 
     def download_file_from_s3(self, s3file, working_dir):
         """ Download s3 file to local
@@ -133,7 +323,11 @@ class ImageGenerator(Process):
             s3 string of file location
         """
         try:
-            return s3.upload(filename, uri, extra={"ACL": "bucket-owner-full-control"})
+            s3_uri = s3.uri_parser(uri)
+            with open(filename, 'rb') as data:
+                self.get_s3_client().upload_fileobj(data, s3_uri['bucket'], s3_uri['key'],
+                                                    ExtraArgs={"ACL": "bucket-owner-full-control"})
+            return 's3://{}/{}'.format(s3_uri['bucket'], s3_uri['key'])
         except botocore.exceptions.ClientError as ex:
             self.logger.error("Error uploading file %s: %s" % (os.path.basename(os.path.basename(filename)), str(ex)), exc_info=True)
             raise ex
@@ -186,30 +380,41 @@ class ImageGenerator(Process):
         activity(cls.cumulus_handler, arn)
 
     def download_palette_files(self, config):
-        """Get palette files for image generations
+        """Get palette files for image generations, palettes are fetched concurrently
+        and cached across invocations
 
         Parameters
         ----------
         config: str
             path location of configuration file
+
+        Returns
+        ----------
+        list
+            names of the palettes downloaded
         """
         # url = "https://hitide.podaac.sit.earthdatacloud.nasa.gov/palettes"
         palette_base_url = os.environ.get("PALETTE_URL")
         with open(config) as json_file:
             data = json.load(json_file)
-            palettes = []
-            for variable in data['imgVariables']:
-                palette = variable.get('palette')
-                if palette not in palettes:
-                    palettes.append(palette)
-                    palette_url = "{}/{}.json".format(palette_base_url, palette)
-                    response = requests.get(palette_url, timeout=60)
-                    palette_full_path = "{}/{}.json".format(self.path, palette)
-                    with open(palette_full_path, 'wb') as file_:
-                        file_.write(response.content)
+        palettes = []
+        for variable in data['imgVariables']:
+            palette = variable.get('palette')
+            if palette not in palettes:
+                palettes.append(palette)
+
+        def download(palette):
+            content = get_file_cache().fetch_url("{}/{}.json".format(palette_base_url, palette))
+            with open("{}/{}.json".format(self.path, palette), 'wb') as file_:
+                file_.write(content)
+
+        if palettes:
+            with ThreadPoolExecutor(max_workers=min(len(palettes), 8)) as executor:
+                list(executor.map(download, palettes))
+        return palettes
 
     def get_config(self):
-        """Get configuration file for image generations
+        """Get configuration file for image generations, configs are cached across invocations
         Returns
         ----------
         str
@@ -221,18 +426,21 @@ class ImageGenerator(Process):
         config_dir = os.environ.get("CONFIG_DIR")
 
         if config_url:
-            file_url = "{}/{}.cfg".format(config_url, config_name)
-            response = requests.get(file_url, timeout=60)
-            cfg_file_full_path = "{}/{}.cfg".format(self.path, config_name)
-            with open(cfg_file_full_path, 'wb') as file_:
-                file_.write(response.content)
-
+            content = get_file_cache().fetch_url("{}/{}.cfg".format(config_url, config_name))
         elif config_bucket and config_dir:
             config_s3 = 's3://{}.cfg'.format(os.path.join(config_bucket, config_dir, config_name))
-            cfg_file_full_path = self.download_file_from_s3(config_s3, self.path)
+            try:
+                content = get_file_cache().fetch_s3(config_s3, self.get_s3_client())
+            except botocore.exceptions.ClientError as ex:
+                self.logger.error("Error downloading file %s: %s" % (config_s3, self.path), exc_info=True)
+                raise ex
         else:
             raise ValueError('Environment variable to get configuration files were not set')
 
+        os.makedirs(self.path, exist_ok=True)
+        cfg_file_full_path = "{}/{}.cfg".format(self.path, config_name)
+        with open(cfg_file_full_path, 'wb') as file_:
+            file_.write(content)
         return cfg_file_full_path
 
     def process(self):
@@ -261,12 +469,16 @@ class ImageGenerator(Process):
             except AttributeError:
                 pass
 
-        self.download_palette_files(config_file_path)
+        # Parse the palettes once, the variable processes inherit them
+        tig.prewarm(self.path, self.download_palette_files(config_file_path))
+
+        work = [(granule['granuleId'], file_) for granule in granules for file_ in granule['files']]
+        uploaded = iter(self.process_pipeline(work, config_file_path))
 
         for granule in granules:
             granule_id = granule['granuleId']
-            for file_ in granule['files']:
-                uploaded_images = self.image_generate(file_, config_file_path, self.path, granule_id)
+            for _ in granule['files']:
+                uploaded_images = next(uploaded)
                 if uploaded_images:
                     append_output[granule_id] = append_output.get(granule_id, []) + uploaded_images
             if granule_id in append_output:
@@ -274,6 +486,79 @@ class ImageGenerator(Process):
 
         return self.input
 
+    def process_pipeline(self, work, config_file):
+        """Generates and uploads the images of each file, with the stages of consecutive
+        files overlapped. Up to get_prefetch_count files are fetched ahead of the one being
+        rendered and the images of a file are uploaded while the next one renders. Rendering
+        waits for the previous upload, so at most two files of images and the fetched inputs
+        are on disk. Inputs are removed once rendered and images once uploaded.
+
+        Parameters
+        ----------
+        work: list
+            (granule_id, file_) of every granule file in order
+        config_file: str
+            File path of configuration file
+
+        Returns
+        -------
+        list
+            List of dictionaries with information about images uploaded to S3
+            for each file, None for files that are not processed
+        """
+        results = [None] * len(work)
+        indices = [index for index, (_, file_) in enumerate(work) if self._is_valid_input(file_)]
+        if not indices:
+            return results
+        variables_config = self._load_config(config_file)
+        prefetch_count = get_prefetch_count()
+
+        # Forked before the fetch and upload threads start, forking while they hold locks is unsafe
+        processes = self._start_processes(config_file, self.path, variables_config)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as fetcher, ThreadPoolExecutor(max_workers=1) as uploader:
+                inputs = deque()
+                upload = None
+                try:
+                    for position, index in enumerate(indices):
+                        granule_id, file_ = work[index]
+                        # Files fetched ahead and their images get their own directories, granules may share file names
+                        for ahead in indices[position + len(inputs):position + prefetch_count + 1]:
+                            inputs.append(fetcher.submit(self._open_input, work[ahead][1], os.path.join(self.path, 'inputs', str(ahead))))
+                        local_file = inputs.popleft().result()
+
+                        image_dir = os.path.join(self.path, 'images', str(index))
+                        image_list = self._generate_images(processes, local_file, image_dir, granule_id)
+                        self._remove_files([local_file])
+
+                        if upload is not None:
+                            results[upload[0]] = upload[1].result()
+                        upload = (index, uploader.submit(self._upload_and_remove, file_, image_list, image_dir))
+
+                    results[upload[0]] = upload[1].result()
+                except Exception as ex:
+                    for future in inputs:
+                        future.cancel()
+                    self.logger.error("Error during image generation: {}".format(ex), exc_info=True)
+                    raise
+        finally:
+            self._stop_processes(processes)
+
+        return results
+
+    def _upload_and_remove(self, file_, image_list, image_dir):
+        """Upload generated images to S3, then remove their directory."""
+        uploaded_files = self._upload_images(file_, image_list)
+        rmtree(image_dir, ignore_errors=True)
+        return uploaded_files
+
+    @staticmethod
+    def _remove_files(paths):
+        """Remove local files that are no longer needed, S3 URIs are left alone."""
+        for path in paths:
+            if path and not path.startswith('s3://') and os.path.isfile(path):
+                os.remove(path)
+
     def generate_file_dictionary(self, file_, image_file, output_file_basename, collection_files, buckets, variable, group):
         """function to generate an information for an image for cumulus
 
@@ -326,51 +611,30 @@ class ImageGenerator(Process):
             self.logger.error("Error generating image data KeyError: {}".format(ex), exc_info=True)
             raise ex
 
-    def image_generate(self, file_, config_file, palette_dir, granule_id):
-        """
-        Main function to handle image generation workflow.
-
-        Parameters
-        ----------
-        file_: dict
-            Dictionary containing data about a granule file.
-        config_file: str
-            File path of configuration file that was downloaded from S3.
-        palette_dir: str
-            Directory of all the palettes for image generation.
-        granule_id: str
-            Granule ID of the granule the images are generated for.
-
-        Returns
-        -------
-        list
-            List of dictionaries with information about images uploaded to S3.
-        """
-        if not self._is_valid_input(file_):
-            return None
-
-        try:
-            local_file = self._download_file(file_)
-            variables_config = self._load_config(config_file)
-            image_list = self._generate_images(local_file, config_file, palette_dir, granule_id, variables_config)
-            uploaded_files = self._upload_images(file_, image_list)
-            return uploaded_files
-
-        except Exception as ex:
-            self.logger.error("Error during image generation: {}".format(ex), exc_info=True)
-            raise
-
     def _is_valid_input(self, file_):
         """Check if the input file is valid for processing."""
         input_file = f's3://{file_["bucket"]}/{file_["key"]}'
         data_type = file_['type']
         return re.match(self.processing_regex, input_file) or data_type == "data"
 
-    def _download_file(self, file_):
-        """Download the input file from S3."""
+    def _open_input(self, file_, path=None):
+        """Return the S3 URI of HDF5 based input files in the ranged TIG_INPUT_MODE,
+        so only the bytes of the configured variables are read, else download the file
+        to path, by default the working directory."""
+        if os.environ.get('TIG_INPUT_MODE', 'download') == 'ranged':
+            input_file = f's3://{file_["bucket"]}/{file_["key"]}'
+            signature = tig.HDF5_SIGNATURE
+            source = tig.S3RangeFile(input_file, block_size=len(signature), client=self.get_s3_client())
+            if source.read(len(signature)) == signature:
+                return input_file
+            self.logger.info("{} is not HDF5 based, downloading it".format(input_file))
+        return self._download_file(file_, path)
+
+    def _download_file(self, file_, path=None):
+        """Download the input file from S3 to path, by default the working directory."""
         input_file = f's3://{file_["bucket"]}/{file_["key"]}'
         try:
-            return s3.download(input_file, path=self.path)
+            return s3.download(input_file, path=path or self.path)
         except botocore.exceptions.ClientError as ex:
             self.logger.error("Error downloading file from S3: {}".format(ex), exc_info=True)
             raise
@@ -384,32 +648,54 @@ class ImageGenerator(Process):
             self.logger.error("Error loading configuration file: {}".format(ex), exc_info=True)
             raise
 
-    def _generate_images(self, local_file, config_file, palette_dir, granule_id, variables_config):
-        """Generate images using multiprocessing."""
-        parent_connections, processes = [], []
-        var_list = [variables_config]
+    def _start_processes(self, config_file, palette_dir, variables_config):
+        """Start the processes generating images, variables are split across processes."""
+        processes = []
+        var_list = partition_variables(variables_config, get_process_count(len(variables_config)))
 
         for variables in var_list:
             if variables:
                 parent_conn, child_conn = mp.Pipe()
-                parent_connections.append(parent_conn)
                 process = mp.Process(
                     target=generate_images,
-                    args=(local_file, self.path, config_file, palette_dir, granule_id, variables, self.logger, child_conn)
+                    args=(config_file, palette_dir, variables, self.logger, child_conn)
                 )
-                processes.append(process)
+                process.start()
+                child_conn.close()
+                processes.append((process, parent_conn))
 
-        for process in processes:
-            process.start()
+        return processes
 
-        image_list, errors = self._collect_process_results(parent_connections)
+    @staticmethod
+    def _stop_processes(processes):
+        """Ask the processes generating images to exit once their current file is done."""
+        for _, parent_conn in processes:
+            try:
+                parent_conn.send(None)
+            except OSError:
+                pass
+            parent_conn.close()
 
-        for process in processes:
+        for process, _ in processes:
             process.join()
 
+    def _generate_images(self, processes, local_file, path, granule_id):
+        """Generate the images of a file to path on the processes from _start_processes."""
+        parent_connections = [parent_conn for _, parent_conn in processes]
+        for parent_conn in parent_connections:
+            parent_conn.send((local_file, path, granule_id))
+
+        image_list, errors = self._collect_process_results(parent_connections)
+
         if errors:
             raise Exception("\n".join(errors))
 
+        # Each process renders its variables group by group, put the images back in group order
+        group_order = {}
+        for image_dict in image_list:
+            group_order.setdefault(image_dict.get('group'), len(group_order))
+        image_list.sort(key=lambda image_dict: group_order[image_dict.get('group')])
+
         return image_list
 
     def _collect_process_results(self, parent_connections):
@@ -424,33 +710,45 @@ class ImageGenerator(Process):
             elif result['status'] == 'success':
                 image_list.extend(result['data'])
 
-        for conn in parent_connections:
-            conn.close()
-
         return image_list, errors
 
     def _upload_images(self, file_, image_list):
-        """Upload generated images to S3."""
-        uploaded_files = []
+        """Upload generated images to S3 on a pool of threads sharing one client.
+        The files keep the order of the images and the first error is raised
+        without waiting for the uploads that have not started."""
         collection_files = self.config.get('collection', {}).get('files', [])
         buckets = self.config.get('buckets')
+        if not image_list:
+            return []
 
-        for image_dict in image_list:
+        self.get_s3_client()
+        with ThreadPoolExecutor(max_workers=get_upload_workers(len(image_list))) as executor:
+            futures = [executor.submit(self._upload_image, file_, image_dict, collection_files, buckets)
+                       for image_dict in image_list]
             try:
-                image_file = image_dict.get('image_file')
-                variable = image_dict.get('variable')
-                group = image_dict.get('group')
-                output_file_basename = os.path.basename(image_file)
-
-                upload_file_dict = self.generate_file_dictionary(
-                    file_, image_file, output_file_basename, collection_files, buckets, variable, group
-                )
-                uploaded_files.append(upload_file_dict)
-            except Exception as ex:
-                self.logger.error("Error uploading image to S3: {}".format(ex), exc_info=True)
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
                 raise
 
-        return uploaded_files
+        return [future.result() for future in futures]
+
+    def _upload_image(self, file_, image_dict, collection_files, buckets):
+        """Upload one generated image to S3."""
+        try:
+            image_file = image_dict.get('image_file')
+            variable = image_dict.get('variable')
+            group = image_dict.get('group')
+            output_file_basename = os.path.basename(image_file)
+
+            return self.generate_file_dictionary(
+                file_, image_file, output_file_basename, collection_files, buckets, variable, group
+            )
+        except Exception as ex:
+            self.logger.error("Error uploading image to S3: {}".format(ex), exc_info=True)
+            raise
 
     @classmethod
     def handler(cls, event, context=None, path=None, noclean=False):
@@ -501,5 +799,9 @@ def handler(event, context):
     return ImageGenerator.cumulus_handler(event, context=context)
 
 
+# Runs once per container in the Lambda init phase
+INIT_TIMINGS = init()
+
+
 if __name__ == "__main__":
     ImageGenerator.cli()
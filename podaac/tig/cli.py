@@ -1,8 +1,161 @@
 """CLI to call tig from command line"""
 
 import argparse
+import contextlib
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+import time
 from podaac.tig import tig
 
+# First bytes of NetCDF classic and NetCDF4/HDF5 files, used to pick granules out of directories
+NETCDF_SIGNATURES = (b'CDF', b'\x89HDF')
+
+# Extensions of text files listing one input per line
+LIST_EXTENSIONS = ('.txt', '.lst')
+
+# Config, palette directory and output directory of a worker process, set once by init_worker
+_worker = {}
+
+
+def is_netcdf(path):
+    """Returns True if the file starts with a NetCDF or HDF5 signature"""
+    with open(path, 'rb') as input_f:
+        header = input_f.read(4)
+    return header.startswith(NETCDF_SIGNATURES)
+
+
+def expand_inputs(inputs, _list_files=()):
+    """
+    Expands the input arguments into a list of granule files. Each input may be
+    a granule, a directory whose NetCDF files are used, a glob pattern or a
+    .txt or .lst file listing one input per line.
+
+    Parameters
+    ----------
+    inputs : list
+        Input arguments
+
+    Returns
+    -------
+    list
+        Granule file paths in the order given, directories and globs sorted
+    """
+    granules = []
+    for path in inputs:
+        if os.path.isdir(path):
+            granules += sorted(entry.path for entry in os.scandir(path) if entry.is_file() and is_netcdf(entry.path))
+        elif glob.has_magic(path):
+            granules += sorted(glob.glob(path))
+        elif path.lower().endswith(LIST_EXTENSIONS) and os.path.isfile(path):
+            list_file = os.path.realpath(path)
+            if list_file in _list_files:
+                logging.warning("Skipping %s, it is already being expanded", path)
+                continue
+            with open(path) as list_f:
+                lines = [line.strip() for line in list_f if line.strip()]
+            granules += expand_inputs(lines, _list_files + (list_file,))
+        else:
+            granules.append(path)
+    return granules
+
+
+def load_setup(config_file, palette_dir):
+    """Parses the config, imports the rendering modules and loads the palettes, raises on a bad config or palette"""
+    config = tig.read_config(config_file)
+    tig.prewarm(palette_dir, {var['palette'] for var in config.get('imgVariables', [])})
+    return config
+
+
+def init_worker(config_file, palette_dir, output_dir):
+    """Loads the config and palettes once per worker process. Errors are kept for
+    render_granule to report with each granule, a pool keeps restarting workers
+    whose initializer raises"""
+    _worker.clear()
+    _worker.update(palette_dir=palette_dir, output_dir=output_dir)
+    try:
+        _worker['config'] = load_setup(config_file, palette_dir)
+    except Exception as ex:  # pylint: disable=broad-exception-caught
+        logging.exception("Could not set up the worker")
+        _worker['error'] = f'Could not set up the worker: {ex}'
+
+
+def render_granule(input_file):
+    """
+    Generates the images of one granule with the config of the worker
+
+    Returns
+    -------
+    dict
+        Summary of the granule with its status, time in seconds, images and error
+    """
+    start = time.time()
+    summary = {'granule': input_file}
+    try:
+        if 'error' in _worker:
+            raise RuntimeError(_worker['error'])
+        image_gen = tig.TIG(input_file, _worker['output_dir'], _worker['config'], _worker['palette_dir'])
+        images = image_gen.generate_images(granule_id=os.path.basename(input_file))
+        summary.update(status='success', images=[image['image_file'] for image in images])
+    except Exception as ex:  # pylint: disable=broad-exception-caught
+        logging.exception("Could not generate images for %s", input_file)
+        summary.update(status='error', error=str(ex))
+    summary['seconds'] = round(time.time() - start, 3)
+    return summary
+
+
+def run_batch(granules, output_dir, config_file, palette_dir, jobs=1, summary_file=None):
+    """
+    Generates images for many granules. Granules are rendered on a pool of jobs
+    worker processes which each parse the config and palettes once, one failed
+    granule does not stop the others. The config and palettes are checked first,
+    a bad setup raises before any granule is rendered.
+
+    Parameters
+    ----------
+    granules : list
+        Granule file paths
+    output_dir : string
+        Directory of the images
+    config_file : string
+        Dataset config file
+    palette_dir : string
+        Directory of the palettes
+    jobs : int
+        Number of worker processes, granules are rendered in this process when 1
+    summary_file : string
+        Optional JSON lines file with the summary of each granule, written as they finish
+
+    Returns
+    -------
+    list
+        Summary of each granule in the order they finished
+    """
+    # A bad config or palette fails the batch here instead of every granule
+    load_setup(config_file, palette_dir)
+
+    summaries = []
+    with contextlib.ExitStack() as stack:
+        summary_f = stack.enter_context(open(summary_file, 'w')) if summary_file else None
+        if jobs > 1:
+            pool = stack.enter_context(mp.Pool(jobs, initializer=init_worker, initargs=(config_file, palette_dir, output_dir)))
+            results = pool.imap_unordered(render_granule, granules)
+        else:
+            init_worker(config_file, palette_dir, output_dir)
+            results = map(render_granule, granules)
+
+        for summary in results:
+            summaries.append(summary)
+            logging.info("%d/%d %s %s in %.1fs", len(summaries), len(granules),
+                         summary['granule'], summary['status'], summary['seconds'])
+            if summary_f:
+                summary_f.write(json.dumps(summary) + '\n')
+                summary_f.flush()
+    return summaries
+
 
 def main() -> None:
     """
@@ -14,19 +167,39 @@ def main() -> None:
     """
     parser = argparse.ArgumentParser(
         description='Config variables subsitatution utility')
-    parser.add_argument('--input_file', type=str, required=True,
-                        help='')
+    parser.add_argument('--input_file', type=str, required=True, nargs='+',
+                        help='Granule files, directories, glob patterns or .txt/.lst files listing them')
     parser.add_argument('--output_dir', type=str, required=True,
                         help='')
     parser.add_argument('--config_file', type=str, required=True,
                         help='')
     parser.add_argument('--palette_dir', type=str, required=True,
                         help='')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of granules rendered in parallel')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='JSON lines file with the status and time of each granule, '
+                             'defaults to tig_summary.jsonl in the output directory for several granules')
 
     args = parser.parse_args()
 
-    image_gen = tig.TIG(args.input_file, args.output_dir, args.config_file, args.palette_dir)
-    image_gen.generate_images(granule_id=args.input_file.split('/')[-1])
+    tig.configure_logging()
+    granules = expand_inputs(args.input_file)
+    summary_file = args.summary
+    if summary_file is None and len(granules) > 1:
+        os.makedirs(args.output_dir, exist_ok=True)
+        summary_file = os.path.join(args.output_dir, 'tig_summary.jsonl')
+
+    try:
+        summaries = run_batch(granules, args.output_dir, args.config_file, args.palette_dir,
+                              jobs=max(args.jobs, 1), summary_file=summary_file)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logging.exception("Could not run the batch")
+        sys.exit(1)
+    failed = [summary['granule'] for summary in summaries if summary['status'] != 'success']
+    if failed:
+        logging.error("Failed %d of %d granules: %s", len(failed), len(summaries), ', '.join(failed))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -10,18 +10,99 @@ Main module for the Tool for Image Generation (TIG)
 import os
 import logging
 import json
-import matplotlib.colors as col
-import matplotlib
-import matplotlib.pyplot as plt
+import hashlib
+import importlib
+import io
+import tempfile
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import numpy.ma as ma
-import xarray as xr
-import pygeogrids.grids as grids
-from scipy.optimize import leastsq
+from PIL import Image
+
+# Images are written without pyplot, never probe for an interactive backend
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+class LazyModule():  # pylint: disable=too-few-public-methods
+    """
+    Stands in for a module that is only imported on first attribute access,
+    so code paths that don't need a heavy module don't pay for importing it
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+matplotlib = LazyModule('matplotlib')
+col = LazyModule('matplotlib.colors')
+mpimg = LazyModule('matplotlib.image')
+xr = LazyModule('xarray')
+grids = LazyModule('pygeogrids.grids')
+boto3 = LazyModule('boto3')
+botocore_config = LazyModule('botocore.config')
+
+# Modules imported ahead of the first granule by prewarm, matplotlib.image loads the font cache
+PREWARM_MODULES = ('matplotlib.colors', 'matplotlib.image', 'xarray', 'pygeogrids.grids')
 
 # One degree in meters
 DEG_M = 111319.490793274
 
+# Neighbor (row, col) offsets, the fill value is taken from the first neighbor with data
+EDGE_NEIGHBORS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+ALL_NEIGHBORS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+# PNG output modes, indexed writes 8-bit paletted PNGs instead of RGBA
+PNG_MODES = ('rgba', 'indexed')
+
+# Approximate number of coordinate values scanned per block
+SCAN_CHUNK_SIZE = 2 ** 20
+
+# Approximate bytes of working memory used per data point when streaming chunks
+STREAM_BYTES_PER_POINT = 96
+
+# Engines available to map data points onto image pixels
+GRIDDING_ENGINES = ('pygeogrids', 'binning')
+
+# Value types used for gridding, see TIG.read_values
+DTYPE_MODES = ('float64', 'float32', 'packed')
+
+# Image outputs, tiles cuts each image into tiles of the tiles steps in degrees
+OUTPUT_MODES = ('image', 'tiles')
+
+# First bytes of HDF5 based files, netCDF4 granules can be read from S3 by byte ranges
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# Default block size and cache size in MB of inputs read from S3 by byte ranges, see S3RangeFile
+RANGE_BLOCK_MB = 4
+RANGE_CACHE_MB = 256
+
+# Modes combining the values that land on the same pixel
+AGGREGATION_MODES = ('mean', 'min', 'max', 'count', 'last')
+
+# Default along-track segmented detrending options, see detrend_swath
+DETREND_DEFAULTS = {
+    'segments': 16,
+    'overlap': 0.5,
+    'cross_track_variable': 'cross_track_distance',
+    'cross_track_window': None,
+    'flag_variable': None,
+    'order': 2,
+    'bad_point_threshold': 0.1,
+    'workers': 1,
+}
+
+# Detrending of SWOT expert ssha_karin_2 images
+SWOT_EXPERT_DETREND = {
+    'cross_track_window': [10e3, 60e3],
+    'flag_variable': 'ancillary_surface_classification_flag',
+}
+
 
 def distance_between_points(lon0, lons, lat0, lats):
     """
@@ -62,6 +143,69 @@ def distance_between_points(lon0, lons, lat0, lats):
     return dist
 
 
+def polyfit_groups(x, p, groups, n_groups, order):
+    """
+    Least squares polynomial fits of p against x for many groups of points at once.
+
+    The fits are linear so they are solved in closed form from the normal equations,
+    which are built for every group with one weighted bincount per power of x. x
+    should be scaled to about [-1, 1] to keep the normal equations well conditioned.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        1D array of finite coordinates
+    p : numpy.ndarray
+        1D array of finite values at x
+    groups : numpy.ndarray
+        1D array with the group index of each point, from 0 to n_groups - 1
+    n_groups : int
+        Number of groups
+    order : int
+        Order of the polynomial
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (n_groups, order + 1) with the coefficients of each group,
+        lowest power first. Groups without enough points get the minimum norm solution.
+    """
+    moments = np.empty((2*order + 1, n_groups))
+    rhs = np.empty((n_groups, order + 1))
+    power = np.ones_like(x)
+    for k in range(2*order + 1):
+        moments[k] = np.bincount(groups, weights=power, minlength=n_groups)
+        if k <= order:
+            rhs[:, k] = np.bincount(groups, weights=p*power, minlength=n_groups)
+        power = power*x
+
+    # Normal matrix of group g is moments[i + j, g]
+    index = np.add.outer(np.arange(order + 1), np.arange(order + 1))
+    normal = np.moveaxis(moments[index], -1, 0)
+    return np.einsum('gij,gj->gi', np.linalg.pinv(normal), rhs)
+
+
+def polyval_groups(coef, x):
+    """
+    Evaluates polynomials with coefficients from polyfit_groups, lowest power first.
+
+    Parameters
+    ----------
+    coef : numpy.ndarray
+        Array of shape (..., order + 1) broadcastable against x
+    x : numpy.ndarray
+        Coordinates to evaluate at
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    values = np.zeros(np.broadcast(x, coef[..., 0]).shape)
+    for k in range(coef.shape[-1] - 1, -1, -1):
+        values = values*x + coef[..., k]
+    return values
+
+
 def fit_bias(ssh, cross_track_distance,
              order=2,
              iter_max=20,
@@ -90,56 +234,112 @@ def fit_bias(ssh, cross_track_distance,
         A 2D array of the phase bias.
 
     """
+    return fit_bias_segments([ssh], [cross_track_distance],
+                             order=order,
+                             iter_max=iter_max,
+                             remove_along_track_polynomial=remove_along_track_polynomial,
+                             check_bad_point_threshold=check_bad_point_threshold)[0]
+
+
+def fit_bias_segments(ssh_segments, distance_segments,
+                      order=2,
+                      iter_max=20,
+                      remove_along_track_polynomial=False,
+                      check_bad_point_threshold=0.6):
+    """
+    Runs fit_bias on several along-track segments at once. The segments must
+    have the same number of cross-track pixels but may have different numbers
+    of lines; they are stacked and padded with NaN lines so every iteration fits
+    both sides of every segment together.
 
-    def err(cc, x0, p, order):  # pylint: disable=inconsistent-return-statements
-        if order == 2:
-            a, b, c = cc
-            return p - (a + b*x0 + c*x0**2)
-        if order == 3:
-            a, b, c, d = cc
-            return p - (a + b*x0 + c*x0**2 + d*x0**3)
-
-    def get_anomaly(ssha, distance, order):
-        msk = np.isfinite(ssha.flatten())
-        if msk.sum() < ssha.size*check_bad_point_threshold:
-            return np.zeros_like(ssha)
-        x = distance
-        xf = x.flatten()[msk]
-        pf = ssha.flatten()[msk]
+    The cross-track polynomials are linear least squares fits solved in closed
+    form. They agree with an iterative scipy.optimize.leastsq fit to within
+    about 1e-9 of the data range.
 
-        cc = [0.0]*(order+1)
-        coef = leastsq(err, cc, args=(xf, pf, order))[0]
-        anomaly = err(coef, x, ssha, order)
+    Parameters
+    ----------
+    ssh_segments : list
+        2D arrays of SSH data.
+    distance_segments : list
+        2D arrays of cross-track distances, one per SSH segment.
+    order, iter_max, remove_along_track_polynomial, check_bad_point_threshold
+        As for fit_bias.
 
+    Returns
+    -------
+    list
+        A 2D array of the phase bias for each segment.
+    """
+    n_segments = len(ssh_segments)
+    n_lines = [np.shape(segment)[0] for segment in ssh_segments]
+    n_pixels = np.shape(ssh_segments[0])[1]
+    shape = (n_segments, max(n_lines), n_pixels)
+
+    ssh = np.full(shape, np.nan)
+    distance = np.full(shape, np.nan)
+    for n, (ssh_segment, distance_segment) in enumerate(zip(ssh_segments, distance_segments)):
+        ssh[n, :n_lines[n]] = ssh_segment
+        distance[n, :n_lines[n]] = distance_segment
+
+    # Each side of each segment is fit separately, -1 for pixels on neither side
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        cdis = np.nanmean(distance, axis=1)/1e3
+    side = np.where(cdis > 0, 0, np.where(cdis < 0, 1, -1))
+    groups = np.where(side >= 0, np.arange(n_segments)[:, np.newaxis]*2 + side, -1)
+    groups = np.broadcast_to(groups[:, np.newaxis, :], shape).copy()
+    groups[np.arange(shape[1]) >= np.array(n_lines)[:, np.newaxis]] = -1
+    in_group = groups >= 0
+    n_groups = 2*n_segments
+    group_size = np.bincount(groups[in_group], minlength=n_groups)
+
+    scale = np.max(np.abs(distance[in_group]), initial=0.0, where=np.isfinite(distance[in_group]))
+    x = distance[in_group]/(scale or 1.0)
+    group_index = groups[in_group]
+
+    fitted_mask = None
+
+    def get_anomaly(ssha):
+        nonlocal fitted_mask
+        values = ssha[in_group]
+        msk = np.isfinite(values) & np.isfinite(x)
+        if fitted_mask is not None and np.array_equal(msk, fitted_mask):
+            # Residuals of a least squares fit refit to zero over the same points
+            return values
+        fitted_mask = msk
+
+        coef = polyfit_groups(x[msk], values[msk], group_index[msk], n_groups, order)
+        anomaly = values - polyval_groups(coef[group_index], x)
+        n_valid = np.bincount(group_index[msk], minlength=n_groups)
+        skipped = n_valid < group_size*check_bad_point_threshold
+        anomaly[skipped[group_index]] = 0.0
         return anomaly
 
-    cdis = np.nanmean(cross_track_distance, axis=0)/1e3
-
-    m1 = cdis > 0
-    m2 = cdis < 0
-
-    ano = np.where(np.isfinite(ssh), np.zeros((ssh.shape)), np.nan)
-    ano[:, m1] = get_anomaly(ssh[:, m1], cross_track_distance[:, m1], order)
-    ano[:, m2] = get_anomaly(ssh[:, m2], cross_track_distance[:, m2], order)
+    ano = np.where(np.isfinite(ssh), 0.0, np.nan)
+    ano[in_group] = get_anomaly(ssh)
 
     for i in range(iter_max//2):  # pylint: disable=unused-variable
-        ano[:, m1] = get_anomaly(ano[:, m1], cross_track_distance[:, m1], order)
-        ano[:, m2] = get_anomaly(ano[:, m2], cross_track_distance[:, m2], order)
-        # ano = np.where(np.abs(ano)>6*np.nanstd(ano),np.nan,ano)
+        ano[in_group] = get_anomaly(ano)
     for i in range(iter_max//2):
-        ano[:, m1] = get_anomaly(ano[:, m1], cross_track_distance[:, m1], order)
-        ano[:, m2] = get_anomaly(ano[:, m2], cross_track_distance[:, m2], order)
-        ano = np.where(np.abs(ano-np.nanmean(ano)) > 5*np.nanstd(ano), np.nan, ano)
+        ano[in_group] = get_anomaly(ano)
+        ano_mean = np.nanmean(ano, axis=(1, 2), keepdims=True)
+        ano_std = np.nanstd(ano, axis=(1, 2), keepdims=True)
+        outliers = np.abs(ano-ano_mean) > 5*ano_std
+        if not outliers.any() and np.array_equal(np.isfinite(ano[in_group]), fitted_mask):
+            # Nothing left to remove, further iterations would not change the anomaly
+            break
+        ano = np.where(outliers, np.nan, ano)
 
     ano = np.where(np.isnan(ssh), np.nan, ano)
-    # mm = m1|m2
-    # ano[:,~mm]=np.nan
 
-    if remove_along_track_polynomial:
-        y = np.arange(ssh.shape[0])[:, np.newaxis]*np.ones_like(ssh)
-        ano = fit_along_track_polynomial(y, ano)
-
-    return ano
+    anomalies = []
+    for n in range(n_segments):
+        segment = ano[n, :n_lines[n]]
+        if remove_along_track_polynomial:
+            y = np.arange(segment.shape[0])[:, np.newaxis]*np.ones_like(segment)
+            segment = fit_along_track_polynomial(y, segment)
+        anomalies.append(segment)
+    return anomalies
 
 
 def fit_along_track_polynomial(y, din):
@@ -162,25 +362,125 @@ def fit_along_track_polynomial(y, din):
 
     """
 
-    def err(cc, y0, p):
-        a, b, c, d, e = cc
-        return p - (a + b*y0 + c*y0**2 + d*y0**3+e*y0**4)
-
     msk = np.isfinite(din.flatten())
     if msk.sum() < din.size/3:
         return np.zeros_like(din)*np.nan
     yf = y.flatten()[msk]
     dd = din.flatten()[msk]
-    cc = [1e-4, 1e-6, 1e-10, 1e-10, 1e-10]
 
-    coef = leastsq(err, cc, args=(yf, dd))[0]
+    scale = np.max(np.abs(yf)) or 1.0
+    coef = polyfit_groups(yf/scale, dd, np.zeros(yf.size, dtype=np.int64), 1, 4)[0]
 
-    anomaly = err(coef, y, din)  # mean surface
+    anomaly = din - polyval_groups(coef, y/scale)  # mean surface
 
     return anomaly
 
 
-class TIG():
+def detrend_swath(data, cross_track_distance,
+                  segments=16,
+                  overlap=0.5,
+                  window=None,
+                  order=2,
+                  check_bad_point_threshold=0.1,
+                  workers=1):
+    """
+    Removes a cross-track polynomial bias from a swath, fit separately on
+    each along-track segment with fit_bias.
+
+    The lines are split into segments of equal, even length with the last
+    segment taking the remainder. Each segment is fit together with a buffer
+    of overlap times the segment length on both sides, and only the lines of
+    the segment itself are kept from its fit.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        A 2D (lines, pixels) array with NaN for missing values
+    cross_track_distance : numpy.ndarray
+        A 2D array of cross-track distances in meters
+    segments : int, optional
+        Number of along-track segments, by default 16
+    overlap : float, optional
+        Fraction of the segment length fit on either side of a segment, by default 0.5
+    window : list, optional
+        Minimum and maximum absolute cross-track distance of the pixels kept, pixels
+        are selected on the mean distance of the fit lines. By default all are kept.
+    order, check_bad_point_threshold
+        As for fit_bias.
+    workers : int, optional
+        Number of threads fitting groups of segments concurrently, by default 1
+
+    Returns
+    -------
+    tuple
+        The detrended 2D array, NaN outside of the window, and a 2D boolean array
+        which is True for pixels inside the window.
+    """
+    total_num_lines = data.shape[0]
+    # make sure it is even
+    n_per_segment = max(int(np.ceil(total_num_lines / segments))//2*2, 2)
+    buffer = int(n_per_segment*overlap)
+
+    bounds = []
+    for n in range(segments):
+        # make index to put the data back
+        ii0 = n*n_per_segment
+        ii1 = total_num_lines if n == segments-1 else min(ii0+n_per_segment, total_num_lines)
+        if ii0 >= ii1:
+            break
+        # add buffer to make sure we have enough data to fit
+        i0 = max(ii0-buffer, 0)
+        i1 = total_num_lines if n == segments-1 else min(ii1+buffer, total_num_lines)
+        bounds.append((i0, i1, ii0, ii1))
+
+    def fit(batch):
+        return fit_bias_segments([data[i0:i1, :] for i0, i1, _, _ in batch],
+                                 [cross_track_distance[i0:i1, :] for i0, i1, _, _ in batch],
+                                 order=order,
+                                 check_bad_point_threshold=check_bad_point_threshold,
+                                 remove_along_track_polynomial=False)
+
+    workers = max(min(workers, len(bounds)), 1)
+    if workers == 1:
+        fitted_segments = fit(bounds)
+    else:
+        batches = np.array_split(np.arange(len(bounds)), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(fit, [[bounds[i] for i in batch] for batch in batches])
+            fitted_segments = [segment for result in results for segment in result]
+
+    detrended = np.full(data.shape, np.nan)
+    in_window = np.ones(data.shape, dtype=bool)
+    for (i0, i1, ii0, ii1), fitted in zip(bounds, fitted_segments):
+        core = fitted[ii0-i0:ii1-i0, :]
+        if window is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                mask_distance = np.abs(np.nanmean(cross_track_distance[i0:i1, :], axis=0))
+            msk = (mask_distance < window[1]) & (mask_distance > window[0])
+            core = np.where(msk, core, np.nan)
+            in_window[ii0:ii1, :] = msk
+        detrended[ii0:ii1, :] = core
+
+    return detrended, in_window
+
+
+def get_detrend_config(var):
+    """
+    Returns the detrending configuration of an image variable or None if it is
+    not detrended. SWOT expert ssha_karin_2 variables use SWOT_EXPERT_DETREND.
+    """
+    detrend = var.get('detrend')
+    if detrend is None and var.get('is_swot_expert') and var.get('id') == "ssha_karin_2":
+        detrend = SWOT_EXPERT_DETREND
+    if detrend is None or detrend is False:
+        return None
+    if detrend is True:
+        return {}
+    return detrend
+
+
+class TIG():  # pylint: disable=too-many-instance-attributes, too-many-public-methods
     """
     TIG is a class used for image generation. It must be initialized
     with an input NetCDF file, output directory, a config file, and
@@ -189,61 +489,57 @@ class TIG():
     output directory.
     """
 
-    def __init__(self, input_file, output_dir, config_file, palette_dir, variables=None, logger=logging):
+    def __init__(self, input_file, output_dir, config_file, palette_dir, variables=None, logger=logging, gridding=None,
+                 scratch_dir=None, lut_cache_dir=None):
         self.input_file = input_file
         self.output_dir = output_dir
         self.palette_dir = palette_dir
-        self.config = read_config(config_file)
+        # An already parsed config can be shared by many granules
+        self.config = config_file if isinstance(config_file, dict) else read_config(config_file)
         self.ppd = int(self.config['image']['ppd'])
+        self.gridding = gridding or self.config.get('gridding', 'pygeogrids')
+        if self.gridding not in GRIDDING_ENGINES:
+            raise ValueError(f'Unknown gridding engine {self.gridding}, expected one of {GRIDDING_ENGINES}')
+        self.png_mode = self.config['image'].get('png_mode', 'rgba')
+        if self.png_mode not in PNG_MODES:
+            raise ValueError(f'Unknown png mode {self.png_mode}, expected one of {PNG_MODES}')
+        self.output_mode = self.config['image'].get('output', 'image')
+        if self.output_mode not in OUTPUT_MODES:
+            raise ValueError(f'Unknown output mode {self.output_mode}, expected one of {OUTPUT_MODES}')
+        self.tile_steps = self.config.get('tiles', {}).get('steps', [30, 14])
+        # Working memory budget in bytes, coordinates and variables are streamed in chunks when set
+        memory_budget = self.config['image'].get('memory_budget_mb')
+        self.memory_budget = int(float(memory_budget) * 2**20) if memory_budget else None
+        self.dtype_mode = self.config['image'].get('dtype', 'float64')
+        if self.dtype_mode not in DTYPE_MODES:
+            raise ValueError(f'Unknown dtype {self.dtype_mode}, expected one of {DTYPE_MODES}')
+        # Directory of the memory mapped files backing image sized arrays, in memory when None
+        self.scratch_dir = scratch_dir or os.environ.get('TIG_SCRATCH_DIR') or None
+        # Look-up tables shared across granules with the same coordinates, see LutCache
+        lut_cache_dir = lut_cache_dir or os.environ.get('TIG_LUT_CACHE_DIR')
+        self.lut_disk_cache = None
+        if lut_cache_dir:
+            self.lut_disk_cache = LutCache(lut_cache_dir, int(float(os.environ.get('TIG_LUT_CACHE_MB', 1024)) * 2**20))
+        # Coarser ppds also written for every image, see block_reduce
+        self.levels = [float(level) for level in self.config['image'].get('levels', [])]
         self.rows = 0
         self.cols = 0
         self.region = Region([-90, 90, -180, 180])
         self.logger = logger
         self.variables = variables
-
-    def _crosses(self, lons):
-        prev = None
-        result = False
-        for x_val in lons.flatten():
-            if prev is None:
-                prev = x_val
-                continue
-            if prev > 0 > x_val and prev - x_val > 200:
-                self.logger.debug(f"prev, x: {prev}, {x_val}")
-                result = True
-            elif x_val > 0 > prev and x_val - prev > 200:
-                self.logger.debug(f"prev, x: {prev}, {x_val}")
-                result = True
-        return result
-
-    def crosses_antimeridian(self, lons):
-        """
-        Checks if an array of longitudinal values crosses the antimeridian
-        Parameters
-        ----------
-        lons : numpy.ndarray
-            An array of longitudinal values
-        Returns
-        -------
-        bool
-            True if data crosses antimeridian.
-        """
-        if len(lons.shape) == 1:
-            if self._crosses(lons):
-                return True
-        else:
-            for x_val in range(lons.shape[0]):
-                if ma.any(lons[x_val, :]):
-                    if self._crosses(lons[x_val, :]):
-                        return True
-                    break
-            if self._crosses(lons[:, 0]):
-                return True
-            if self._crosses(lons[lons.shape[0]-1, :]):
-                return True
-            if self._crosses(lons[:, lons.shape[1]-1]):
-                return True
-        return False
+        # Look-up tables keyed by (group, rows, cols), shared by all variables of a group
+        self._lut_cache = {}
+        # Coordinate scans keyed by group
+        self._coordinate_scans = {}
+        # Whether longitudes are 0 to 360 keyed by coordinate group
+        self._is360 = {}
+        # Image grids keyed by rows, cols and region for the pygeogrids engine
+        self._image_grids = {}
+        # Local path, or a file reading only the byte ranges needed from an s3:// input
+        self.input_source = open_input(input_file)
+        self.dataset_session = DatasetSession(self.input_source)
+        # Undecoded datasets for the float32 and packed dtype modes
+        self.raw_dataset_session = DatasetSession(self.input_source, mask_and_scale=False)
 
     def get_lon_lat_grids(self, rows, cols):
         """
@@ -261,126 +557,160 @@ class TIG():
         exact_lons = lons[:cols]
         exact_lats = lats[:rows]
 
-        lon_grid, lat_grid = np.meshgrid(exact_lons, exact_lats)
+        lon_grid = allocate_array((rows, cols), 0.0, scratch_dir=self.scratch_dir)
+        lat_grid = allocate_array((rows, cols), 0.0, scratch_dir=self.scratch_dir)
+        lon_grid[:] = exact_lons
+        lat_grid[:] = exact_lats[:, np.newaxis]
         return (lon_grid, lat_grid)
 
-    def get_lon_lat(self, param_group=None):
+    def get_lon_lat(self, param_group=None, rows=None):
         """
         Function to get the longitude masked array and latatiude masked array
 
+        Parameters
+        ----------
+        param_group : string
+            Optional group to read the coordinates from
+        rows : slice
+            Optional rows to read, by default the whole arrays are read
+
         Returns
         -------
             return a longitude and latitude masked array
         """
 
-        group, _, lon_var = self.config['lonVar'].rpartition('/')
-        _, _, lat_var = self.config['latVar'].rpartition('/')
-
-        if param_group:
-            group = param_group
-        local_dataset = xr.open_dataset(self.input_file, group=group, decode_times=False)
+        group, lon_var, lat_var = self.get_coordinate_names(param_group)
+        local_dataset = self.dataset_session.open_group(group)
 
-        lon_array = local_dataset[lon_var].to_masked_array()
-        lat_array = local_dataset[lat_var].to_masked_array()
+        lon_array = local_dataset[lon_var]
+        lat_array = local_dataset[lat_var]
+        if rows is not None:
+            lon_array = lon_array[rows]
+            lat_array = lat_array[rows]
+        if self.dtype_mode != 'float64':
+            lon_array = lon_array.astype(np.float32)
+            lat_array = lat_array.astype(np.float32)
+        lon_array = lon_array.to_masked_array()
+        lat_array = lat_array.to_masked_array()
 
         # Need to check if the array crosses the antimeridian
         if 'is360' in self.config:
             is360 = self.config['is360']
         else:
-            self.logger.debug("Calculating is 360")
-            lon_scale = local_dataset[lon_var].encoding['scale_factor']
-            lon_offset = local_dataset[lon_var].encoding['add_offset']
-            is360 = is_360(local_dataset[lon_var], lon_scale, lon_offset)
+            if group not in self._is360:
+                self.logger.debug("Calculating is 360")
+                lon_scale = local_dataset[lon_var].encoding['scale_factor']
+                lon_offset = local_dataset[lon_var].encoding['add_offset']
+                self._is360[group] = is_360(local_dataset[lon_var], lon_scale, lon_offset)
+            is360 = self._is360[group]
         if is360:
             self.logger.debug("Is 360")
             lon_array = ((lon_array + 180) % 360.0) - 180
         lon_array = ma.masked_where(abs(lon_array) > 180, lon_array)
         lat_array = ma.masked_where(abs(lat_array) > 90, lat_array)
 
-        local_dataset.close()
         return lon_array, lat_array
 
-    def get_swot_expert_data(self, group):
-        """Function to get data for swot expert collection specifically for ssha_karin_2 data."""
-
-        local_dataset = xr.open_dataset(
-            self.input_file, group=group, decode_times=False)
-        flag = local_dataset.ancillary_surface_classification_flag
-        lon = local_dataset.longitude.values
-        lat = local_dataset.latitude.values
-
-        cross_track_distance = local_dataset.cross_track_distance.values
-        ssha = local_dataset.ssha_karin_2
-        ssha_1 = np.where(flag == 0, ssha, np.nan)
-        local_dataset.close()
-
-        lon_segments = []
-        lat_segments = []
-        data_segments = []
-        n_segments = 16
-        total_num_lines = local_dataset.num_lines.size
-        # make sure it is even
-        n_per_segment = int(np.ceil(total_num_lines / n_segments))//2*2
-
-        for n in range(n_segments):
-
-            # add buffer to make sure we have enough data to fit
-            i0 = n*n_per_segment-n_per_segment//2
-            # add buffer to make sure we have enough data to fit
-            i1 = (n+1)*n_per_segment + n_per_segment//2
-            if n == 0:
-                i0 = 0
-            elif n == n_segments-1:
-                i1 = total_num_lines
-
-            data_modify = ssha_1[i0:i1, :]
-            new_distance = cross_track_distance[i0:i1, :]
-
-            ssha_2 = fit_bias(
-                data_modify, new_distance,
-                check_bad_point_threshold=0.1,
-                remove_along_track_polynomial=False
-            )
-
-            mask_distance = np.nanmean(new_distance, axis=0)
-            msk = (np.abs(mask_distance) < 60e3) & (
-                np.abs(mask_distance) > 10e3)
-            ssha_2[:, ~msk] = np.nan
-
-            # make index to put the data back
-            ii0 = n*n_per_segment
-            ii1 = ii0+n_per_segment
-
-            if n == n_segments-1:
-                ii1 = total_num_lines
-
-            lon_modify = lon[ii0:ii1, :]
-            lat_modify = lat[ii0:ii1, :]
-
-            lon_modify[:, ~msk] = np.nan
-            lat_modify[:, ~msk] = np.nan
-
-            if n == 0:
-                data_segments.append(ssha_2[0:ii1, :])
-            elif n == n_segments-1:
-                data_segments.append(ssha_2[n_per_segment//2:, :])
-            else:
-                data_segments.append(
-                    ssha_2[n_per_segment//2:n_per_segment+n_per_segment//2])
+    def get_coordinate_names(self, param_group=None):
+        """
+        Returns the group, longitude and latitude variable names of the coordinates
+        """
+        group, _, lon_var = self.config['lonVar'].rpartition('/')
+        _, _, lat_var = self.config['latVar'].rpartition('/')
+
+        if param_group:
+            group = param_group
+        return group, lon_var, lat_var
+
+    def get_coordinate_shape(self, param_group=None):
+        """
+        Returns the shape of the coordinate arrays without reading them
+        """
+        group, lon_var, _ = self.get_coordinate_names(param_group)
+        return self.dataset_session.open_group(group)[lon_var].shape
+
+    def get_rectilinear_dims(self, param_group=None):
+        """
+        Returns the (latitude, longitude) dimensions when the coordinates are the
+        1-D axes of a rectilinear grid, None when they locate each data point
+        """
+        group, lon_var, lat_var = self.get_coordinate_names(param_group)
+        local_dataset = self.dataset_session.open_group(group)
+        lon_dims = local_dataset[lon_var].dims
+        lat_dims = local_dataset[lat_var].dims
+        if len(lon_dims) == 1 and len(lat_dims) == 1 and lon_dims != lat_dims:
+            return lat_dims[0], lon_dims[0]
+        return None
+
+    def iter_lon_lat(self, param_group=None):
+        """
+        Reads the coordinates in blocks of rows sized to the memory budget.
+
+        Parameters
+        ----------
+        param_group : string
+            Optional group to read the coordinates from
+
+        Yields
+        ------
+        tuple
+            The rows slice and the longitude and latitude masked arrays of each block
+        """
+        shape = self.get_coordinate_shape(param_group)
+        row_size = int(np.prod(shape[1:]))
+        chunk_rows = max(1, self.memory_budget // (row_size * STREAM_BYTES_PER_POINT))
+        for start in range(0, shape[0], chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            yield (rows, *self.get_lon_lat(param_group, rows=rows))
+
+    def get_detrended_data(self, group, variable, lon_array, lat_array, detrend):
+        """
+        Function to get data detrended segment by segment along track, see detrend_swath.
+
+        Parameters
+        ----------
+        group : string
+            The group name of the variable
+        variable : string
+            The variable name
+        lon_array : numpy.ndarray
+            Longitudes of the variable
+        lat_array : numpy.ndarray
+            Latitudes of the variable
+        detrend : dict
+            Detrending configuration, see DETREND_DEFAULTS
+
+        Returns
+        -------
+        tuple
+            Flattened longitude, latitude and detrended variable arrays
+        """
+
+        detrend = {**DETREND_DEFAULTS, **detrend}
+        local_dataset = self.dataset_session.open_group(group)
+
+        data = np.asarray(local_dataset[variable].values, dtype=np.float64)
+        if detrend['flag_variable']:
+            data = np.where(local_dataset[detrend['flag_variable']] == 0, data, np.nan)
+        cross_track_distance = local_dataset[detrend['cross_track_variable']].values
+
+        if data.ndim != 2 or data.shape != np.shape(lon_array) or data.shape != cross_track_distance.shape:
+            raise ValueError(f'Can not detrend {variable}, expected a 2D swath matching the coordinates and cross track distances')
 
-            lon_segments.append(lon_modify)
-            lat_segments.append(lat_modify)
+        detrended, in_window = detrend_swath(data, cross_track_distance,
+                                             segments=int(detrend['segments']),
+                                             overlap=float(detrend['overlap']),
+                                             window=detrend['cross_track_window'],
+                                             order=int(detrend['order']),
+                                             check_bad_point_threshold=float(detrend['bad_point_threshold']),
+                                             workers=int(detrend['workers']))
 
-        lon_array = np.concatenate([segment.flatten()
-                                   for segment in lon_segments])
-        lat_array = np.concatenate([segment.flatten()
-                                   for segment in lat_segments])
-        var_array = np.concatenate([segment.flatten()
-                                   for segment in data_segments])
+        lon_array = np.where(in_window, ma.filled(lon_array.astype(np.float64), np.nan), np.nan)
+        lat_array = np.where(in_window, ma.filled(lat_array.astype(np.float64), np.nan), np.nan)
 
-        return lon_array, lat_array, var_array
+        return lon_array.flatten(), lat_array.flatten(), detrended.flatten()
 
-    def generate_images(self, image_format='png', world_file=False, granule_id=""):
+    def generate_images(self, image_format='png', world_file=False, granule_id="", levels=None):
         """
         Generates images for each configured variable in a NetCDF file.
         Parameters
@@ -391,22 +721,35 @@ class TIG():
             Output an Esri world file for each image that can be used by GIS tools
        granule_id : string
             The granule_id of the granule file
+        levels : list
+            Optional coarser ppds to also write each image at, overrides the
+            levels of the image configuration. The data is only gridded at the
+            full ppd and each level is block reduced from it.
         Returns
         -------
         list
             List of output image file locations
         """
 
+        levels = self.levels if levels is None else [float(level) for level in levels]
+
         self.logger.info(f"\nProcessing {self.input_file}")
         output_images = []
-        if self.config.get('multi_lon_lat'):
-            for group in self.config.get('multi_groups'):
-                output_images += self.generate_images_group(image_format, world_file, granule_id, group=group)
-        else:
-            output_images = self.generate_images_group(image_format, world_file, granule_id, group=None)
+        try:
+            if self.config.get('multi_lon_lat'):
+                for group in self.config.get('multi_groups'):
+                    output_images += self.generate_images_group(image_format, world_file, granule_id, group=group, levels=levels)
+            else:
+                output_images = self.generate_images_group(image_format, world_file, granule_id, group=None, levels=levels)
+        finally:
+            self.dataset_session.close()
+            self.raw_dataset_session.close()
+            if isinstance(self.input_source, S3RangeFile):
+                self.logger.info(f"Read {self.input_source.bytes_fetched} of {self.input_source.size} bytes "
+                                 f"in {self.input_source.requests} requests")
         return output_images
 
-    def generate_images_group(self, image_format='png', world_file=False, granule_id="", group=None):
+    def generate_images_group(self, image_format='png', world_file=False, granule_id="", group=None, levels=None):
         """
         Generates images for each configured variable in a NetCDF file.
         Parameters
@@ -419,6 +762,8 @@ class TIG():
             The granule_id of the granule file
         param_group : string
             The group name in which the dataset file will be open with
+        levels : list
+            Coarser ppds to also write each image at, defaults to the configured levels
         Returns
         -------
         list
@@ -432,22 +777,25 @@ class TIG():
             self.logger.debug("No alpha channel")
             alpha = False
 
-        lon_array, lat_array = self.get_lon_lat(param_group=group)
+        if self.memory_budget and self.get_rectilinear_dims(group) is None:
+            # Streamed variables read the coordinates chunk by chunk
+            lon_array, lat_array = None, None
+        else:
+            lon_array, lat_array = self.get_lon_lat(param_group=group)
 
-        # Get Bounds of the dataset
-        eastern = lon_array.max()
-        western = lon_array.min()
-        northern = lat_array.max()
-        southern = lat_array.min()
+        # Get bounds, validity and antimeridian crossing of the dataset
+        scan = self.get_coordinate_scan(lon_array, lat_array, group)
+        if scan.valid_pairs == 0:
+            raise Exception("Can't generate images for empty granule")
 
         # Calculate output dimensions
-        if not self.crosses_antimeridian(lon_array):
+        if not scan.crosses_antimeridian:
             self.logger.debug("Region does not crosses 180/-180")
-            region = (southern, northern, western, eastern)
+            region = (scan.min_lat, scan.max_lat, scan.min_lon, scan.max_lon)
         else:
             # Image spans antimeridian, wrap it.
             self.logger.debug("Region crosses 180/-180")
-            region = (southern, northern, -180, 180)
+            region = (scan.min_lat, scan.max_lat, -180, 180)
 
         if self.config.get('global_grid', False):
             region = (-90, 90, -180, 180)
@@ -457,9 +805,6 @@ class TIG():
         width_deg = region[3] - region[2]
         self.region = Region(region)
 
-        if self.are_all_lon_lat_invalid(lon_array, lat_array):
-            raise Exception("Can't generate images for empty granule")
-
         output_dimensions = (int(height_deg * self.ppd), int(width_deg * self.ppd))
         (self.rows, self.cols) = output_dimensions
 
@@ -478,125 +823,87 @@ class TIG():
                 new_dimensions = (int(height_deg * var.get('ppd')), int(width_deg * var.get('ppd')))
                 override_rows, override_cols = new_dimensions
 
-            output_image_file = self.process_variable(var,
-                                                      lon_array,
-                                                      lat_array,
-                                                      alpha,
-                                                      image_format,
-                                                      world_file,
-                                                      granule_id,
-                                                      group,
-                                                      override_rows,
-                                                      override_cols)
-            if output_image_file is not None:
+            output_image_files = self.process_variable(var,
+                                                       lon_array,
+                                                       lat_array,
+                                                       alpha,
+                                                       image_format,
+                                                       world_file,
+                                                       granule_id,
+                                                       group,
+                                                       override_rows,
+                                                       override_cols,
+                                                       levels)
+            for output_image_file in output_image_files:
                 output_images.append({'image_file': output_image_file, 'variable': var['id'], 'group': group})
 
         self.logger.info("Finished processing variables")
         return output_images
 
-    def get_non_black_neighbor_value(self, img, x, y):
+    def get_coordinate_scan(self, lon_array, lat_array, group=None):
         """
-        Get the value of a neighboring pixel that isn't black for a given pixel coordinate in an image array.
-
-        Parameters:
-        - img: NumPy array representing the image.
-        - x: Row coordinate of the pixel.
-        - y: Column coordinate of the pixel.
-
-        Returns:
-        - Value of a neighboring pixel that isn't black, or None if all neighbors are black.
+        Returns the coordinate scan of a group, scanning the coordinates on first use
+        Parameters
+        ----------
+        lon_array : numpy.ndarray
+            An array of longitudinal values, None to stream them from the group
+        lat_array : numpy.ndarray
+            An array of latitude values, None to stream them from the group
+        group : string
+            The group the coordinates were read from
+        Returns
+        -------
+        CoordinateScan
         """
-        height, width = img.shape[:2]
-
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                # Skip the central pixel itself
-                if i == 0 and j == 0:
-                    continue
-
-                # Calculate neighboring pixel coordinates
-                neighbor_x = x + i
-                neighbor_y = y + j
-
-                # Check if the neighbor is within the image bounds
-                if 0 <= neighbor_x < height and 0 <= neighbor_y < width:
-                    neighbor_value = img[neighbor_x, neighbor_y]
-
-                    # Check if the neighbor is not black (assuming black is 0)
-                    if not np.isnan(neighbor_value):
-                        return neighbor_value
-
-        # Return None if all neighbors are black
-        return None
+        if group not in self._coordinate_scans:
+            if self.get_rectilinear_dims(group) is not None:
+                self._coordinate_scans[group] = scan_rectilinear_coordinates(lon_array, lat_array)
+            elif lon_array is None:
+                self._coordinate_scans[group] = scan_coordinate_chunks(chunk[1:] for chunk in self.iter_lon_lat(group))
+            else:
+                self._coordinate_scans[group] = scan_coordinates(lon_array, lat_array)
+        return self._coordinate_scans[group]
 
-    def fill_swath_with_neighboring_pixel(self, output_array):
+    def fill_swath_with_neighboring_pixel(self, output_array, passes=1):
         """
-        This method fills NaN values in the input image with RGB values from neighboring pixels.
-        The replacement values are chosen randomly from non-missing pixel portions of the image.
-        The probability of selecting a value is inversely proportional to the distance from the NaN position.
+        This method fills NaN values in the input image with values from neighboring pixels.
 
-        The function uses a helper function `non_nan_neighbors` to check if the neighboring values of a given
-        position are not NaN. It then retrieves x and y coordinates of NaN values with at least one non-NaN neighbor
-        and fills the NaN values in the copy with values from these neighbors.
+        A NaN pixel is filled when at least one of its up, down, left or right neighbors has data.
+        Its value is taken from the first of its eight neighbors that has data, scanning the rows
+        above to below and the columns left to right. Each step works on whole shifted arrays
+        rather than pixel by pixel.
 
         Parameters:
         - output_array (numpy.ndarray): Input image with missing data represented as NaN values.
+        - passes (int): Number of times the fill is repeated, each pass grows the data by one pixel.
 
         Returns:
         numpy.ndarray: (numpy.ndarray): Output image with missing values surrounded by data filled in.
         """
 
-        def non_nan_neighbors(arr, x, y):
-            """
-            Check if there is at least one non-NaN neighbor for a given position.
-
-            Parameters:
-            - arr (numpy.ndarray): Input array.
-            - x (int): x-coordinate of the position.
-            - y (int): y-coordinate of the position.
-
-            Returns:
-            bool: True if there is at least one non-NaN neighbor, False otherwise.
-            """
-            neighbors = [
-                (x-1, y), (x+1, y),  # Left and right neighbors
-                (x, y-1), (x, y+1)   # Up and down neighbors
-            ]
-
-            return any(0 <= i < arr.shape[0] and 0 <= j < arr.shape[1] and not np.isnan(arr[i, j]) for i, j in neighbors)
-
-        # Get the indices of NaN values
         img_with_neighbor_filled = output_array.copy()
-        x_swath, y_swath = zip(*[(x, y) for x, y in zip(*np.where(np.isnan(output_array))) if non_nan_neighbors(output_array, x, y)])
-
-        for index, (x, y) in enumerate(zip(x_swath, y_swath)):  # pylint: disable=unused-variable
-            value = self.get_non_black_neighbor_value(output_array, x, y)
-            if value is not None:
-                img_with_neighbor_filled[x, y] = value
+        for _ in range(passes):
+            source = img_with_neighbor_filled
+            has_data = ~np.isnan(source)
+
+            # NaN pixels with at least one non-NaN up, down, left or right neighbor
+            to_fill = np.zeros_like(has_data)
+            for offset in EDGE_NEIGHBORS:
+                dst, src = neighbor_slices(source.shape, offset)
+                to_fill[dst] |= has_data[src]
+            to_fill &= ~has_data
+            if not to_fill.any():
+                break
+
+            img_with_neighbor_filled = source.copy()
+            for offset in ALL_NEIGHBORS:
+                dst, src = neighbor_slices(source.shape, offset)
+                take = to_fill[dst] & has_data[src]
+                img_with_neighbor_filled[dst][take] = source[src][take]
+                to_fill[dst] &= ~take
 
         return img_with_neighbor_filled
 
-    def are_all_lon_lat_invalid(self, lon, lat):
-        """
-        Checks if all coordinate pairs contain at least one invalid value.
-
-        Parameters:
-            lon (array-like): Array of longitude values.
-            lat (array-like): Array of latitude values.
-        Returns:
-            bool: True if all coordinate pairs have at least one invalid value,
-                  False if there exists at least one valid coordinate pair.
-        """
-        try:
-            # Define valid ranges
-            valid_lon_mask = (lon >= -180) & (lon <= 180)
-            valid_lat_mask = (lat >= -90) & (lat <= 90)
-            # Check if any pair is completely valid
-            valid_pairs = valid_lon_mask & valid_lat_mask
-            return not valid_pairs.any()
-        except Exception as e:
-            raise RuntimeError(f"Error checking longitude/latitude validity: {e}") from e
-
     def process_variable(self,
                          var,
                          lon_array,
@@ -607,7 +914,8 @@ class TIG():
                          granule_id="",
                          param_group=None,
                          override_rows=None,
-                         override_cols=None):
+                         override_cols=None,
+                         levels=None):
         """
         Processes an invidual variable to generate an image
         Parameters
@@ -628,6 +936,8 @@ class TIG():
             The granule_id of the granule file
         param_group : string
             The group name in which the dataset file will be open with
+        levels : list
+            Coarser ppds to also write the image at, defaults to the configured levels
         Returns
         -------
         list
@@ -641,11 +951,9 @@ class TIG():
         group, _, variable = config_variable.rpartition('/')
         if param_group:
             group = param_group
-        local_dataset = xr.open_dataset(self.input_file, group=group, decode_times=False)
-
-        # Get variable array and fill value
-        var_array = local_dataset[variable].to_masked_array().flatten()
+        local_dataset = self.dataset_session.open_group(group)
 
+        # Get fill value
         try:
             fill_value = local_dataset[variable].encoding['_FillValue']
         except KeyError:
@@ -653,7 +961,6 @@ class TIG():
             fill_value = var.get('fill_value')
             if fill_value is None:
                 raise KeyError(f'There is no fill value for variable {variable}') from KeyError
-        local_dataset.close()
 
         # Get palette info
         self.logger.info(f"palette: {var['palette']}")
@@ -670,43 +977,27 @@ class TIG():
         rows = override_rows if override_rows else self.rows
         cols = override_cols if override_cols else self.cols
 
-        if var.get('is_swot_expert') and var.get('id') == "ssha_karin_2":
-            lon_array, lat_array, var_array = self.get_swot_expert_data(group_string)
-
         try:
             # Generate an array to populate data for image output
-            output_vals = self.generate_image_output(var_array,
-                                                     lon_array,
-                                                     lat_array,
-                                                     fill_value,
-                                                     rows,
-                                                     cols)
-            output_vals[output_vals == fill_value] = np.nan
-            out_array = np.flip(output_vals.flatten().reshape(rows, cols), 0)
+            output_vals = self.grid_variable(var, group, variable, lon_array, lat_array, fill_value, rows, cols, param_group)
+            out_array = np.flip(output_vals.reshape(rows, cols), 0)
 
             if var.get('fill_missing'):
-                out_array = self.fill_swath_with_neighboring_pixel(out_array)
-
-            # Color the image output array and save to a file
-            plt.imsave(output_location,
-                       out_array,
-                       vmin=float(var['min']),
-                       vmax=float(var['max']),
-                       cmap=colormap,
-                       format=image_format)
-
-            self.logger.info(f"Wrote {output_location}")
-
-            # Create world file if specified
-            if world_file:
-                output_wld = output_location.replace(image_format, 'wld')
-                wld_string = create_world_file((self.region.max_lon-self.region.min_lon)/cols,
-                                               (self.region.max_lat-self.region.min_lat)/rows,
-                                               self.region.max_lat,
-                                               self.region.min_lon)
-                with open(output_wld, 'w') as wld:
-                    wld.write(wld_string)
-                self.logger.info(f"Wrote {output_wld}")
+                out_array = self.fill_swath_with_neighboring_pixel(out_array, passes=int(var.get('fill_missing_passes', 1)))
+
+            pixel_size = ((self.region.max_lon-self.region.min_lon)/cols, (self.region.max_lat-self.region.min_lat)/rows)
+            output_locations = self.write_image(output_location, out_array, var, colormap, image_format, world_file, pixel_size)
+
+            # Coarser levels are reduced from the full resolution image
+            ppd = var.get('ppd') or self.ppd
+            for level in self.levels if levels is None else levels:
+                factor = level_factor(ppd, level)
+                level_location = "{}/{}".format(self.output_dir, '.'.join(
+                    x for x in [granule_id, group_string, variable, f'ppd{level:g}', image_format] if x))
+                output_locations += self.write_image(level_location,
+                                                     block_reduce(out_array, factor, var.get('level_reduction', 'mean')),
+                                                     var, colormap, image_format, world_file,
+                                                     (pixel_size[0]*factor, pixel_size[1]*factor))
 
         except grids.GridDefinitionError:
             self.logger.warning("Could not grid variable %s", variable.split('/')[-1], exc_info=True)
@@ -715,76 +1006,792 @@ class TIG():
             self.logger.warning("Could not image variable %s", variable.split('/')[-1], exc_info=True)
             raise
 
-        # Return output image location
-        return output_location
+        # Return output image locations
+        return output_locations
 
-    def generate_image_output(self,
-                              var_array,
-                              lon_array,
-                              lat_array,
-                              fill_value,
-                              rows,
-                              cols
-                              ):
+    def grid_variable(self, var, group, variable, lon_array, lat_array, fill_value, rows, cols, param_group=None):
         """
-        Generates output that matches image extents using discrete global grids
+        Reads a variable and maps its values onto the image pixels. Variables on a
+        rectilinear grid are resampled axis by axis. Variables with the shape of the
+        coordinates are streamed in chunks when there is a memory budget, other
+        variables and detrended variables are read at once.
         Parameters
         ----------
-        var_array : numpy.ndarray
-            An array of variable values
+        var : dict
+            A dictionary object containing configuration parameters for a variable
+        group : string
+            The group of the variable
+        variable : string
+            The variable name
         lon_array : numpy.ndarray
-            An array of longitudinal values
+            An array of longitudinal values, None if the coordinates are streamed
         lat_array : numpy.ndarray
-            An array of latitude values
+            An array of latitude values, None if the coordinates are streamed
         fill_value : float
             The fill value used in the variable array
+        param_group : string
+            The group name in which the dataset file will be open with
         Returns
         -------
         numpy.ndarray
             An array of values that matches image output dimensions
         """
 
-        # Generate a grid matching the output image
-        lon_grid, lat_grid = self.get_lon_lat_grids(rows, cols)
-        image_grid = grids.BasicGrid(lon_grid.flatten(),
-                                     lat_grid.flatten(),
-                                     shape=(rows, cols))
-
-        # Generate a grid matching the dataset
-        data_grid = grids.BasicGrid(lon_array.flatten(), lat_array.flatten())
+        local_dataset = self.dataset_session.open_group(group)
+        detrend = get_detrend_config(var)
+
+        # Compact values mark missing data with NaN
+        dtype = np.float64
+        if self.dtype_mode != 'float64' and detrend is None:
+            fill_value = np.nan
+            dtype = np.float32
+
+        dims = self.get_rectilinear_dims(param_group)
+        if dims is not None and detrend is None and set(dims) <= set(local_dataset[variable].dims):
+            output_vals = self.generate_rectilinear_image_output(group,
+                                                                 variable,
+                                                                 dims,
+                                                                 lon_array,
+                                                                 lat_array,
+                                                                 fill_value,
+                                                                 rows,
+                                                                 cols,
+                                                                 aggregation=var.get('aggregation'),
+                                                                 dtype=dtype)
+            output_vals[output_vals == fill_value] = np.nan
+            return output_vals
+
+        if self.memory_budget and detrend is None and \
+                local_dataset[variable].shape == self.get_coordinate_shape(param_group):
+            output_vals = self.generate_streamed_image_output(group,
+                                                              variable,
+                                                              param_group,
+                                                              fill_value,
+                                                              rows,
+                                                              cols,
+                                                              aggregation=var.get('aggregation'),
+                                                              dtype=dtype)
+            output_vals[output_vals == fill_value] = np.nan
+            return output_vals
 
-        # Generate a look-up table between the image and data grid
-        lut = data_grid.calc_lut(image_grid)
+        if lon_array is None:
+            self.logger.debug(f"Reading all coordinates for {variable}")
+            lon_array, lat_array = self.get_lon_lat(param_group)
 
-        # Generate an array for output values
-        output_vals = np.full(rows * cols, fill_value, dtype=np.float64)
+        # Detrended data masks its own coordinates so its look-up table can't be shared
+        lut_key = (param_group, rows, cols)
+        if detrend is not None:
+            lon_array, lat_array, var_array = self.get_detrended_data(group, variable, lon_array, lat_array, detrend)
+            lut_key = None
+        else:
+            var_array = self.read_values(group, variable)
+
+        output_vals = self.generate_image_output(var_array,
+                                                 lon_array,
+                                                 lat_array,
+                                                 fill_value,
+                                                 rows,
+                                                 cols,
+                                                 lut_key=lut_key,
+                                                 aggregation=var.get('aggregation'),
+                                                 dtype=dtype)
+        output_vals[output_vals == fill_value] = np.nan
+        return output_vals
 
-        # Iterate through valid values in var_array, remove nan values
-        valid_values = ~np.isnan(var_array)
-        lut = lut[valid_values]
-        var_array = var_array[valid_values]
+    def read_values(self, group, variable, rows=None):
+        """
+        Reads the flattened values of a variable for gridding. By default they are
+        decoded to a float64 masked array. The float32 dtype mode decodes them to
+        float32 with NaN for missing values, the packed mode returns the raw values
+        which are only decoded for the points that land on the image.
+        Parameters
+        ----------
+        group : string
+            The group of the variable
+        variable : string
+            The variable name
+        rows : slice
+            Optional rows to read, by default the whole variable is read
+        Returns
+        -------
+        numpy.ndarray or PackedValues
+        """
+        if self.dtype_mode == 'float64':
+            data_array = self.dataset_session.open_group(group)[variable]
+            if rows is not None:
+                data_array = data_array[rows]
+            return data_array.to_masked_array().flatten()
+
+        data_array = self.raw_dataset_session.open_group(group)[variable]
+        if rows is not None:
+            data_array = data_array[rows]
+        attrs = data_array.attrs
+        fill_values = [attrs[name] for name in ('_FillValue', 'missing_value') if name in attrs]
+        values = PackedValues(data_array.values.ravel(),
+                              attrs.get('scale_factor', 1.0),
+                              attrs.get('add_offset', 0.0),
+                              np.ravel(fill_values))
+        if self.dtype_mode == 'packed':
+            return values
+        return values.decode()
+
+    def read_grid_values(self, group, variable, dims, grid_rows=None, grid_cols=None):
+        """
+        Reads the values of a variable on a rectilinear grid as a 2-D array with
+        NaN for missing values, decoded to float32 in the compact dtype modes.
+        Parameters
+        ----------
+        group : string
+            The group of the variable
+        variable : string
+            The variable name
+        dims : tuple
+            The latitude and longitude dimensions of the grid
+        grid_rows : numpy.ndarray
+            Optional sorted indices of the grid rows to read
+        grid_cols : numpy.ndarray
+            Optional sorted indices of the grid columns to read
+        Returns
+        -------
+        numpy.ndarray
+            The values with shape (rows, columns)
+        """
+        session = self.dataset_session if self.dtype_mode == 'float64' else self.raw_dataset_session
+        data_array = session.open_group(group)[variable]
+        lat_dim, lon_dim = dims
+
+        # Grids often have a leading time dimension of length one
+        indexers = {dim: 0 for dim in data_array.dims if dim not in dims}
+        if any(data_array.sizes[dim] != 1 for dim in indexers):
+            raise ValueError(f'Variable {variable} has more than one {lat_dim} by {lon_dim} grid')
+        if grid_rows is not None:
+            indexers[lat_dim] = grid_rows
+        if grid_cols is not None:
+            indexers[lon_dim] = grid_cols
+        data_array = data_array.isel(indexers).transpose(lat_dim, lon_dim)
+
+        if self.dtype_mode == 'float64':
+            return ma.filled(data_array.to_masked_array().astype(np.float64), np.nan)
+
+        attrs = data_array.attrs
+        fill_values = [attrs[name] for name in ('_FillValue', 'missing_value') if name in attrs]
+        values = PackedValues(data_array.values.ravel(),
+                              attrs.get('scale_factor', 1.0),
+                              attrs.get('add_offset', 0.0),
+                              np.ravel(fill_values))
+        return values.decode().reshape(data_array.shape)
+
+    def get_lut(self, lon_array, lat_array, rows, cols, lut_key=None):
+        """
+        Returns the look-up table between the data grid and the image grid.
+        Parameters
+        ----------
+        lon_array : numpy.ndarray
+            An array of longitudinal values
+        lat_array : numpy.ndarray
+            An array of latitude values
+        rows : int
+            Number of rows in the image grid
+        cols : int
+            Number of columns in the image grid
+        lut_key : tuple
+            Optional cache key, variables sharing coordinates and image
+            dimensions reuse the same look-up table
+        Returns
+        -------
+        numpy.ndarray
+            Index of the image pixel for each data point
+        """
+        if lut_key is not None and lut_key in self._lut_cache:
+            self.logger.debug(f"Reusing look-up table for {lut_key}")
+            return self._lut_cache[lut_key]
+
+        cache_key = None
+        if self.lut_disk_cache is not None:
+            cache_key = lut_cache_key(lon_array, lat_array, self.region, rows, cols, self.gridding)
+            lut = self.lut_disk_cache.get(cache_key)
+            if lut is not None:
+                self.logger.debug(f"Loaded look-up table {cache_key}")
+                if lut_key is not None:
+                    self._lut_cache[lut_key] = lut
+                return lut
+
+        if self.gridding == 'binning':
+            lut = calc_binned_lut(lon_array, lat_array, self.region, rows, cols)
+        else:
+            # Generate a grid matching the output image, its KD-tree is kept with it
+            grid_key = (rows, cols, self.region.min_lat, self.region.max_lat, self.region.min_lon, self.region.max_lon)
+            if grid_key not in self._image_grids:
+                lon_grid, lat_grid = self.get_lon_lat_grids(rows, cols)
+                self._image_grids = {grid_key: grids.BasicGrid(lon_grid.ravel(),
+                                                               lat_grid.ravel(),
+                                                               shape=(rows, cols))}
+            image_grid = self._image_grids[grid_key]
+
+            # Generate a grid matching the dataset
+            data_grid = grids.BasicGrid(lon_array.flatten(), lat_array.flatten())
+
+            # Generate a look-up table between the image and data grid
+            lut = data_grid.calc_lut(image_grid)
+
+        if cache_key is not None:
+            self.lut_disk_cache.put(cache_key, lut)
+        if lut_key is not None:
+            self._lut_cache[lut_key] = lut
+        return lut
+
+    def write_image(self, output_location, out_array, var, colormap, image_format, world_file, pixel_size):
+        """
+        Saves a gridded array to an image file and optionally its world file.
+        In tiles output mode the array is cut into tiles of the tiles steps
+        in degrees and only the tiles with data are saved.
+        Parameters
+        ----------
+        output_location : string
+            Path of the image file
+        out_array : numpy.ndarray
+            A 2D array of values, NaN where there is no data
+        var : dict
+            A dictionary object containing configuration parameters for a variable
+        colormap : Colormap
+            The colormap of the variable
+        image_format : string
+            Any output image formatted supported by matplotlib
+        world_file : bool
+            Output an Esri world file for the image that can be used by GIS tools
+        pixel_size : tuple
+            Width and height of a pixel in degrees
+        Returns
+        -------
+        list
+            List of output image file locations
+        """
 
-        # Find valid indices within the bounds of output_vals
-        valid_indices_lut = (0 <= lut) & (lut < len(output_vals))
-        # Filter lut to include only valid indices
-        lut = lut[valid_indices_lut]
+        if self.output_mode == 'tiles':
+            stem = output_location[:-len(image_format)]
+            windows = [(f'{stem}x{x}y{y}.{image_format}', r0, r1, c0, c1)
+                       for x, y, r0, r1, c0, c1 in tile_windows(self.region.min_lon, self.region.max_lat,
+                                                                pixel_size, out_array.shape, self.tile_steps)]
+        else:
+            windows = [(output_location, 0, out_array.shape[0], 0, out_array.shape[1])]
 
-        # Replace the loop with NumPy indexing
-        valid_indices = np.where(output_vals[lut] == fill_value)[0]
-        output_vals[lut[valid_indices]] = var_array[valid_indices]
+        output_locations = []
+        for location, r0, r1, c0, c1 in windows:
+            window = out_array[r0:r1, c0:c1]
+            if self.output_mode == 'tiles' and np.isnan(window).all():
+                continue
 
-        # Return output values
-        return output_vals
+            # Color the image output array and save to a file
+            self.save_image(location, window, var, colormap, image_format)
+            self.logger.info(f"Wrote {location}")
+            output_locations.append(location)
 
+            # Create world file if specified
+            if world_file:
+                output_wld = location.replace(image_format, 'wld')
+                wld_string = create_world_file(pixel_size[0],
+                                               pixel_size[1],
+                                               self.region.max_lat - r0*pixel_size[1],
+                                               self.region.min_lon + c0*pixel_size[0])
+                with open(output_wld, 'w') as wld:
+                    wld.write(wld_string)
+                self.logger.info(f"Wrote {output_wld}")
 
-class Region():
-    """
-    Object that stores the extents of a given region
-    """
+        return output_locations
 
-    def __init__(self, region):
-        self._min_lat = region[0]
-        self._max_lat = region[1]
+    def save_image(self, output_location, out_array, var, colormap, image_format='png'):
+        """
+        Colors a gridded array and saves it to an image file
+        Parameters
+        ----------
+        output_location : string
+            Path of the image file
+        out_array : numpy.ndarray
+            A 2D array of values, NaN where there is no data
+        var : dict
+            A dictionary object containing configuration parameters for a variable
+        colormap : Colormap
+            The colormap of the variable
+        image_format : string
+            Any output image formatted supported by matplotlib
+        """
+        if self.png_mode == 'indexed' and image_format == 'png':
+            if write_indexed_png(output_location, out_array, float(var['min']), float(var['max']), colormap):
+                return
+            self.logger.debug(f"Too many colors in {colormap.name} for an indexed png")
+
+        mpimg.imsave(output_location,
+                     out_array,
+                     vmin=float(var['min']),
+                     vmax=float(var['max']),
+                     cmap=colormap,
+                     format=image_format)
+
+    def generate_image_output(self,
+                              var_array,
+                              lon_array,
+                              lat_array,
+                              fill_value,
+                              rows,
+                              cols,
+                              lut_key=None,
+                              aggregation=None,
+                              dtype=np.float64
+                              ):
+        """
+        Generates output that matches image extents using discrete global grids
+        Parameters
+        ----------
+        var_array : numpy.ndarray
+            An array of variable values
+        lon_array : numpy.ndarray
+            An array of longitudinal values
+        lat_array : numpy.ndarray
+            An array of latitude values
+        fill_value : float
+            The fill value used in the variable array
+        lut_key : tuple
+            Optional key used to cache the look-up table
+        aggregation : string
+            Optional mode combining the values that land on the same pixel,
+            one of AGGREGATION_MODES. By default each pixel keeps a single value.
+        dtype : numpy.dtype
+            Type of the output values
+        Returns
+        -------
+        numpy.ndarray
+            An array of values that matches image output dimensions
+        """
+
+        lut = self.get_lut(lon_array, lat_array, rows, cols, lut_key=lut_key)
+
+        accumulator = PixelAccumulator(rows * cols, aggregation, fill_value, dtype=dtype, scratch_dir=self.scratch_dir)
+        accumulator.add(lut, var_array)
+
+        # Return output values
+        return accumulator.result()
+
+    def generate_streamed_image_output(self, group, variable, param_group, fill_value, rows, cols, aggregation=None,
+                                       dtype=np.float64):
+        """
+        Generates the same output as generate_image_output, reading the variable
+        and its coordinates in blocks of rows sized to the memory budget
+        Parameters
+        ----------
+        group : string
+            The group of the variable
+        variable : string
+            The variable name, the variable has the same shape as the coordinates
+        param_group : string
+            The group of the coordinates
+        fill_value : float
+            The fill value used in the variable array
+        aggregation : string
+            Optional mode combining the values that land on the same pixel
+        dtype : numpy.dtype
+            Type of the output values
+        Returns
+        -------
+        numpy.ndarray
+            An array of values that matches image output dimensions
+        """
+
+        accumulator = PixelAccumulator(rows * cols, aggregation, fill_value, dtype=dtype, scratch_dir=self.scratch_dir)
+        for chunk_rows, lon_chunk, lat_chunk in self.iter_lon_lat(param_group):
+            var_chunk = self.read_values(group, variable, rows=chunk_rows)
+            accumulator.add(self.get_lut(lon_chunk, lat_chunk, rows, cols), var_chunk)
+        return accumulator.result()
+
+    def generate_rectilinear_image_output(self, group, variable, dims, lon_array, lat_array, fill_value, rows, cols,
+                                          aggregation=None, dtype=np.float64):
+        """
+        Generates output that matches image extents for a variable on a rectilinear
+        grid from separate column and row index maps, without expanding the 1-D
+        coordinates to 2-D or building a KD-tree. By default each image pixel takes
+        the value of the nearest grid cell and only the grid rows and columns used
+        by the image are read. With an aggregation the grid cells are binned onto
+        the image pixels as in generate_image_output.
+        Parameters
+        ----------
+        group : string
+            The group of the variable
+        variable : string
+            The variable name
+        dims : tuple
+            The latitude and longitude dimensions of the grid
+        lon_array : numpy.ndarray
+            The longitudes of the grid columns
+        lat_array : numpy.ndarray
+            The latitudes of the grid rows
+        fill_value : float
+            The fill value used in the variable array
+        aggregation : string
+            Optional mode combining the values that land on the same pixel
+        dtype : numpy.dtype
+            Type of the output values
+        Returns
+        -------
+        numpy.ndarray
+            An array of values that matches image output dimensions
+        """
+        x_size = (self.region.max_lon - self.region.min_lon) / cols
+        y_size = (self.region.max_lat - self.region.min_lat) / rows
+        global_image = bool(np.isclose(self.region.max_lon - self.region.min_lon, 360))
+
+        if aggregation is None:
+            col_index = nearest_axis_indices(lon_array, self.region.min_lon + np.arange(cols) * x_size,
+                                             period=360 if global_image else None)
+            row_index = nearest_axis_indices(lat_array, self.region.min_lat + np.arange(rows) * y_size)
+            image_cols = np.flatnonzero(col_index >= 0)
+            image_rows = np.flatnonzero(row_index >= 0)
+            grid_cols, col_inverse = np.unique(col_index[image_cols], return_inverse=True)
+            grid_rows, row_inverse = np.unique(row_index[image_rows], return_inverse=True)
+
+            output_vals = allocate_array((rows, cols), fill_value, dtype=dtype, scratch_dir=self.scratch_dir)
+            if grid_cols.size and grid_rows.size:
+                values = self.read_grid_values(group, variable, dims, grid_rows, grid_cols)
+                values = np.where(np.isnan(values), fill_value, values)
+                output_vals[np.ix_(image_rows, image_cols)] = values[np.ix_(row_inverse, col_inverse)]
+            return output_vals.reshape(-1)
+
+        lons = ma.filled(ma.masked_invalid(ma.asarray(lon_array, dtype=np.float64)), np.nan)
+        lats = ma.filled(ma.masked_invalid(ma.asarray(lat_array, dtype=np.float64)), np.nan)
+        col_bins = axis_bins(lons, self.region.min_lon, x_size, cols, periodic=global_image)
+        row_bins = axis_bins(lats, self.region.min_lat, y_size, rows)
+        lut = row_bins[:, np.newaxis] * cols + col_bins
+        lut[(row_bins < 0)[:, np.newaxis] | (col_bins < 0)] = -1
+
+        accumulator = PixelAccumulator(rows * cols, aggregation, fill_value, dtype=dtype, scratch_dir=self.scratch_dir)
+        accumulator.add(lut.ravel(), self.read_grid_values(group, variable, dims).ravel())
+        return accumulator.result()
+
+
+class CoordinateScan():  # pylint: disable=too-few-public-methods
+    """
+    Bounds, number of valid coordinate pairs and antimeridian crossing of a
+    set of coordinates
+    """
+
+    def __init__(self, min_lon, max_lon, min_lat, max_lat, valid_pairs, crosses_antimeridian):
+        self.min_lon = min_lon
+        self.max_lon = max_lon
+        self.min_lat = min_lat
+        self.max_lat = max_lat
+        self.valid_pairs = valid_pairs
+        self.crosses_antimeridian = crosses_antimeridian
+
+
+class DatasetSession():
+    """
+    Keeps a single open dataset per group of an input file so coordinates,
+    fill values and variables are all read from the same handle instead of
+    re-parsing the group metadata for every variable. The input is a path or
+    a file object such as S3RangeFile, which is read with the h5netcdf engine.
+    """
+
+    def __init__(self, input_file, mask_and_scale=True):
+        self.input_file = input_file
+        self.mask_and_scale = mask_and_scale
+        self._datasets = {}
+
+    def open_group(self, group=None):
+        """
+        Returns the dataset for a group, opening it on first use
+        Parameters
+        ----------
+        group : string
+            The group name, None or empty for the root group
+        Returns
+        -------
+        xarray.Dataset
+        """
+        key = (group or '').strip('/')
+        if key not in self._datasets:
+            engine = None if isinstance(self.input_file, (str, os.PathLike)) else 'h5netcdf'
+            self._datasets[key] = xr.open_dataset(self.input_file, group=key or None, decode_times=False,
+                                                  mask_and_scale=self.mask_and_scale, engine=engine)
+        return self._datasets[key]
+
+    def close(self):
+        """Closes every dataset opened by this session"""
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_s3_client(max_pool_connections=10):
+    """Creates an S3 client like cumulus_process.s3 does, pointing at LocalStack
+    when LOCALSTACK_HOST is set, with max_pool_connections connections to share
+    between threads"""
+    config = botocore_config.Config(max_pool_connections=max_pool_connections)
+    localstack = os.getenv('LOCALSTACK_HOST')
+    if localstack:
+        return boto3.client('s3',
+                            region_name='us-east-1',
+                            endpoint_url=f'http://{localstack}:4566',
+                            use_ssl=False,
+                            aws_access_key_id='fake-key',
+                            aws_secret_access_key='fake-secret',
+                            config=config)
+    return boto3.client('s3', config=config)
+
+
+class S3RangeFile(io.RawIOBase):  # pylint: disable=too-many-instance-attributes
+    """
+    Read only file object over an S3 object that fetches byte ranges on demand,
+    so only the parts of a granule that are read are transferred. Reads are
+    served from a cache of fixed size blocks, consecutive missing blocks are
+    fetched with a single ranged GET and the least recently used blocks are
+    dropped past max_cache_bytes. Requests and bytes fetched are counted.
+    """
+
+    def __init__(self, uri, block_size=RANGE_BLOCK_MB * 2**20, max_cache_bytes=RANGE_CACHE_MB * 2**20, client=None):
+        super().__init__()
+        self.uri = uri
+        self.bucket, _, self.key = uri[len('s3://'):].partition('/')
+        self.client = client or get_s3_client()
+        self.block_size = int(block_size)
+        self.max_blocks = max(1, int(max_cache_bytes) // self.block_size)
+        self.size = self.client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        self.position = 0
+        self.requests = 1
+        self.bytes_fetched = 0
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        end = min(self.position + len(view), self.size)
+        if end <= self.position:
+            return 0
+
+        first, last = self.position // self.block_size, (end - 1) // self.block_size
+        self._fetch(first, last)
+        written = 0
+        for index in range(first, last + 1):
+            self._blocks.move_to_end(index)
+            offset = index * self.block_size
+            start = max(self.position, offset) - offset
+            stop = min(end, offset + self.block_size) - offset
+            view[written:written + stop - start] = self._blocks[index][start:stop]
+            written += stop - start
+        self.position = end
+
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return written
+
+    def _fetch(self, first, last):
+        """Fetches the missing blocks from first to last, one request per run of consecutive blocks"""
+        index = first
+        while index <= last:
+            if index in self._blocks:
+                index += 1
+                continue
+            stop = index
+            while stop < last and stop + 1 not in self._blocks:
+                stop += 1
+            byte_range = f'bytes={index * self.block_size}-{min((stop + 1) * self.block_size, self.size) - 1}'
+            body = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=byte_range)['Body'].read()
+            self.requests += 1
+            self.bytes_fetched += len(body)
+            for block in range(index, stop + 1):
+                offset = (block - index) * self.block_size
+                self._blocks[block] = body[offset:offset + self.block_size]
+            index = stop + 1
+
+
+def open_input(input_file):
+    """
+    Opens an input for reading, s3:// URIs are read by byte ranges with the
+    block and cache sizes of the TIG_RANGE_BLOCK_MB and TIG_RANGE_CACHE_MB
+    environment variables. Only HDF5 based granules, such as netCDF4, can be
+    read this way.
+    Parameters
+    ----------
+    input_file : string
+        Path or s3:// URI of the input file
+    Returns
+    -------
+    string or S3RangeFile
+        The local path or a file object reading the S3 object
+    """
+    if isinstance(input_file, str) and input_file.startswith('s3://'):
+        return S3RangeFile(input_file,
+                           block_size=float(os.environ.get('TIG_RANGE_BLOCK_MB') or RANGE_BLOCK_MB) * 2**20,
+                           max_cache_bytes=float(os.environ.get('TIG_RANGE_CACHE_MB') or RANGE_CACHE_MB) * 2**20)
+    return input_file
+
+
+class PackedValues():
+    """
+    Raw values of a variable as stored in the file, along with the scale factor,
+    add offset and fill values needed to decode them
+    """
+
+    def __init__(self, values, scale_factor, add_offset, fill_values):
+        self.values = values
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+        self.fill_values = fill_values
+
+    def valid(self):
+        """
+        Returns a boolean array which is True for values that are not fill values or NaN
+        """
+        valid = ~np.isin(self.values, self.fill_values)
+        if np.issubdtype(self.values.dtype, np.floating):
+            valid &= ~np.isnan(self.values)
+        return valid
+
+    def decode(self, index=None):
+        """
+        Decodes the values to float32, fill values become NaN
+        Parameters
+        ----------
+        index : numpy.ndarray
+            Optional boolean index of the values to decode, which must all be valid.
+            By default every value is decoded.
+        Returns
+        -------
+        numpy.ndarray
+        """
+        if index is None:
+            values = self.values.astype(np.float32)
+            values[~self.valid()] = np.nan
+        else:
+            values = self.values[index].astype(np.float32)
+        values *= np.float32(self.scale_factor)
+        values += np.float32(self.add_offset)
+        return values
+
+
+class LutCache():
+    """
+    Directory of look-up tables saved as .npy files named by lut_cache_key, so
+    granules with the same coordinates can reuse them across runs and processes.
+    Tables are memory mapped when loaded and the least recently used ones are
+    removed once the directory holds more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """
+        Returns the memory mapped look-up table saved under key, None if there is none
+        """
+        path = os.path.join(self.directory, f'{key}.npy')
+        try:
+            lut = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return lut
+
+    def put(self, key, lut):
+        """
+        Saves a look-up table under key then evicts least recently used tables
+        """
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as lut_f:
+            np.save(lut_f, np.asarray(lut, dtype=np.int64))
+        # Other processes only ever see complete files
+        os.replace(lut_f.name, os.path.join(self.directory, f'{key}.npy'))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used look-up tables until the cache fits in max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def lut_cache_key(lon_array, lat_array, region, rows, cols, gridding):
+    """
+    Returns a hex digest identifying the look-up table of coordinates on an image grid
+    Parameters
+    ----------
+    lon_array : numpy.ndarray
+        An array of longitudinal values, masked values are only hashed by their mask
+    lat_array : numpy.ndarray
+        An array of latitude values
+    region : Region
+        Extents of the image
+    rows : int
+        Number of rows in the image grid
+    cols : int
+        Number of columns in the image grid
+    gridding : string
+        The gridding engine
+    Returns
+    -------
+    string
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((region.min_lat, region.max_lat, region.min_lon, region.max_lon, rows, cols, gridding)).encode())
+    for array in (lon_array, lat_array):
+        data = np.ascontiguousarray(ma.filled(array, 0))
+        digest.update(repr((data.dtype.str, data.shape)).encode())
+        digest.update(data)
+        digest.update(np.ascontiguousarray(ma.getmaskarray(array)))
+    return digest.hexdigest()
+
+
+class Region():
+    """
+    Object that stores the extents of a given region
+    """
+
+    def __init__(self, region):
+        self._min_lat = region[0]
+        self._max_lat = region[1]
         self._min_lon = region[2]
         self._max_lon = region[3]
 
@@ -809,6 +1816,511 @@ class Region():
         return self._max_lon
 
 
+def neighbor_slices(shape, offset):
+    """
+    Returns the slices pairing every pixel with its neighbor at an offset
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2D image
+    offset : tuple
+        (row, col) offset of the neighbor
+    Returns
+    -------
+    tuple
+        Slices of the pixels that have such a neighbor and slices of those neighbors
+    """
+    dst, src = [], []
+    for size, step in zip(shape, offset):
+        dst.append(slice(max(-step, 0), size - max(step, 0)))
+        src.append(slice(max(step, 0), size - max(-step, 0)))
+    return tuple(dst), tuple(src)
+
+
+def crosses_from(first, lons):
+    """
+    Checks if longitudes jump across the antimeridian relative to a first longitude
+    Parameters
+    ----------
+    first : float
+        The first longitude of the line
+    lons : numpy.ndarray
+        The following longitudes of the line
+    Returns
+    -------
+    bool
+        True if any longitude is more than 200 degrees away on the other side of 0
+    """
+    if first is ma.masked:
+        return False
+    jumps = ((first > 0) & (lons < 0) & (first - lons > 200)) | ((lons > 0) & (first < 0) & (lons - first > 200))
+    return bool(ma.filled(jumps, False).any())
+
+
+def scan_coordinates(lon_array, lat_array, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Computes the bounds, the number of valid coordinate pairs and whether the
+    longitudes cross the antimeridian in one pass over the coordinates. The
+    arrays are processed in blocks of rows so temporaries stay small.
+    Parameters
+    ----------
+    lon_array : numpy.ndarray
+        An array of longitudinal values
+    lat_array : numpy.ndarray
+        An array of latitude values with the same shape
+    chunk_size : int
+        Approximate number of values processed per block
+    Returns
+    -------
+    CoordinateScan
+    """
+    lon_array = ma.asarray(lon_array)
+    lat_array = ma.asarray(lat_array)
+    if lon_array.shape != lat_array.shape:
+        raise RuntimeError(f"Error checking longitude/latitude validity: shapes {lon_array.shape} and {lat_array.shape} differ")
+
+    if lon_array.ndim == 0 or lon_array.size == 0:
+        return CoordinateScan(None, None, None, None, 0, False)
+
+    row_size = lon_array.size // lon_array.shape[0]
+    chunk_rows = max(1, chunk_size // max(row_size, 1))
+    return scan_coordinate_chunks((lon_array[start:start + chunk_rows], lat_array[start:start + chunk_rows])
+                                  for start in range(0, lon_array.shape[0], chunk_rows))
+
+
+def scan_rectilinear_coordinates(lon_array, lat_array):
+    """
+    Computes the coordinate scan of a rectilinear grid from its 1-D longitude
+    and latitude axes, every valid longitude pairs with every valid latitude.
+    Parameters
+    ----------
+    lon_array : numpy.ndarray
+        The longitudes of the grid columns
+    lat_array : numpy.ndarray
+        The latitudes of the grid rows
+    Returns
+    -------
+    CoordinateScan
+    """
+    lon_array = ma.masked_invalid(ma.ravel(lon_array))
+    lat_array = ma.masked_invalid(ma.ravel(lat_array))
+    lon_values = lon_array.compressed()
+    lat_values = lat_array.compressed()
+    valid_lons = int(((lon_values >= -180) & (lon_values <= 180)).sum())
+    valid_lats = int(((lat_values >= -90) & (lat_values <= 90)).sum())
+    return CoordinateScan(lon_values.min() if lon_values.size else None,
+                          lon_values.max() if lon_values.size else None,
+                          lat_values.min() if lat_values.size else None,
+                          lat_values.max() if lat_values.size else None,
+                          valid_lons * valid_lats,
+                          lon_array.size > 1 and crosses_from(lon_array[0], lon_array[1:]))
+
+
+def scan_coordinate_chunks(chunks):
+    """
+    Computes the coordinate scan of scan_coordinates from consecutive blocks
+    of rows of the coordinates, so they never have to be read all at once.
+    Parameters
+    ----------
+    chunks : iterable
+        (longitude, latitude) masked arrays of each block of rows, in order
+    Returns
+    -------
+    CoordinateScan
+    """
+    lon_min, lon_max, lat_min, lat_max = [], [], [], []
+    valid_pairs = 0
+    crosses = False
+    first_row = None
+    first_data_row = None
+    last_row = None
+
+    for lon_chunk, lat_chunk in chunks:
+        lon_chunk = ma.asarray(lon_chunk)
+        lat_chunk = ma.asarray(lat_chunk)
+        if lon_chunk.size == 0:
+            continue
+        if first_row is None:
+            first_row = lon_chunk[0]
+        last_row = lon_chunk[-1]
+
+        lon_values = lon_chunk.compressed()
+        if lon_values.size:
+            lon_min.append(lon_values.min())
+            lon_max.append(lon_values.max())
+        lat_values = lat_chunk.compressed()
+        if lat_values.size:
+            lat_min.append(lat_values.min())
+            lat_max.append(lat_values.max())
+
+        valid = (lon_chunk >= -180) & (lon_chunk <= 180) & (lat_chunk >= -90) & (lat_chunk <= 90)
+        valid_pairs += int(ma.filled(valid, False).sum())
+
+        if crosses:
+            continue
+        if lon_chunk.ndim == 1:
+            crosses = crosses_from(first_row, lon_chunk)
+            continue
+
+        # Check the first row with data plus the first and last columns
+        if first_data_row is None:
+            rows_with_data = np.flatnonzero(ma.filled(lon_chunk, 0).reshape(lon_chunk.shape[0], -1).any(axis=1))
+            if rows_with_data.size:
+                first_data_row = ma.ravel(lon_chunk[rows_with_data[0]])
+                crosses = crosses_from(first_data_row[0], first_data_row[1:])
+        crosses = crosses or crosses_from(ma.ravel(first_row[0])[0], ma.ravel(lon_chunk[:, 0])) or \
+            crosses_from(ma.ravel(first_row[-1])[0], ma.ravel(lon_chunk[:, -1]))
+
+    if last_row is not None and np.ndim(last_row) > 0 and not crosses:
+        last_row = ma.ravel(last_row)
+        crosses = crosses_from(last_row[0], last_row[1:])
+
+    return CoordinateScan(min(lon_min, default=None),
+                          max(lon_max, default=None),
+                          min(lat_min, default=None),
+                          max(lat_max, default=None),
+                          valid_pairs,
+                          crosses)
+
+
+class PixelAccumulator():
+    """
+    Combines the values that land on each image pixel over one or more batches
+    of data points, so the points can be gridded in chunks. Without a mode each
+    pixel is assigned the values that land on it in turn, otherwise the mode is
+    one of AGGREGATION_MODES. The pixel arrays are memory mapped under
+    scratch_dir when given.
+    """
+
+    def __init__(self, size, mode, fill_value, dtype=np.float64, scratch_dir=None):
+        if mode is not None and mode not in AGGREGATION_MODES:
+            raise ValueError(f'Unknown aggregation {mode}, expected one of {AGGREGATION_MODES}')
+        self.size = size
+        self.mode = mode
+        self.fill_value = fill_value
+        self.scratch_dir = scratch_dir
+        self.output_vals = allocate_array(size, fill_value, dtype=dtype, scratch_dir=scratch_dir)
+        self.counts = None if mode is None else allocate_array(size, 0, dtype=np.int64, scratch_dir=scratch_dir)
+        self.reduced = None
+        if mode in ('mean', 'min', 'max'):
+            initial = {'mean': 0.0, 'min': np.inf, 'max': -np.inf}[mode]
+            self.reduced = allocate_array(size, initial, scratch_dir=scratch_dir)
+
+    def add(self, lut, values):
+        """
+        Adds a batch of data points
+        Parameters
+        ----------
+        lut : numpy.ndarray
+            Pixel index of each value, values out of range of the pixels are ignored
+        values : numpy.ndarray or PackedValues
+            Values of the data points, NaN values are ignored. Packed values
+            are only decoded for the points that are added.
+        """
+        # Remove nan values and pixel indices outside of the output
+        if isinstance(values, PackedValues):
+            valid_values = values.valid()
+        else:
+            values = ma.getdata(values)
+            valid_values = ~np.isnan(values)
+        lut = lut[valid_values]
+        valid_indices_lut = (0 <= lut) & (lut < self.size)
+        lut = lut[valid_indices_lut]
+        if isinstance(values, PackedValues):
+            values = values.decode(valid_values)[valid_indices_lut]
+        else:
+            values = values[valid_values][valid_indices_lut]
+
+        if self.mode is None:
+            self.output_vals[lut] = values
+            return
+
+        counts = np.bincount(lut, minlength=self.size)
+        self.counts += counts
+        if self.mode == 'mean':
+            self.reduced += np.bincount(lut, weights=values, minlength=self.size)
+        elif self.mode == 'min':
+            np.minimum.at(self.reduced, lut, values)
+        elif self.mode == 'max':
+            np.maximum.at(self.reduced, lut, values)
+        elif self.mode == 'last':
+            # Index of the last value of each pixel
+            last = np.zeros(self.size, dtype=np.int64)
+            np.maximum.at(last, lut, np.arange(lut.size))
+            has_data = counts > 0
+            self.output_vals[has_data] = values[last[has_data]]
+
+    def result(self):
+        """
+        Returns the pixel values, the fill value for pixels without data
+        """
+        if self.mode in (None, 'last'):
+            return self.output_vals
+
+        output_vals = self.output_vals
+        has_data = self.counts > 0
+        if self.mode == 'count':
+            output_vals[has_data] = self.counts[has_data]
+        elif self.mode == 'mean':
+            output_vals[has_data] = self.reduced[has_data]/self.counts[has_data]
+        else:
+            output_vals[has_data] = self.reduced[has_data]
+        return output_vals
+
+
+def allocate_array(shape, fill_value, dtype=np.float64, scratch_dir=None):
+    """
+    Returns a new array filled with fill_value. With a scratch_dir the array is
+    a np.memmap of a file in that directory, so the operating system can page it
+    out to disk. The file is removed right away and its space is freed once the
+    array is no longer referenced.
+
+    Parameters
+    ----------
+    shape : int or tuple
+        Shape of the array
+    fill_value : scalar
+        Initial value of the elements
+    dtype : numpy.dtype
+        Type of the elements
+    scratch_dir : string
+        Optional directory of the memory mapped file
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if scratch_dir is None or np.prod(shape) == 0:
+        return np.full(shape, fill_value, dtype=dtype)
+
+    os.makedirs(scratch_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=scratch_dir, prefix='tig-', suffix='.raster') as scratch:
+        array = np.memmap(scratch, dtype=dtype, mode='w+', shape=shape)
+    array[...] = fill_value
+    return array
+
+
+def tile_windows(min_lon, max_lat, pixel_size, shape, steps):
+    """
+    Splits an image into tiles on a global grid of fixed size in degrees, with
+    tile x counted east from -180 and tile y counted south from 90. Tile edges
+    are rounded to the nearest image pixel.
+
+    Parameters
+    ----------
+    min_lon : float
+        Longitude of the left edge of the image
+    max_lat : float
+        Latitude of the top edge of the image
+    pixel_size : tuple
+        Width and height of a pixel in degrees
+    shape : tuple
+        Rows and columns of the image
+    steps : list
+        Width and height of a tile in degrees
+
+    Returns
+    -------
+    list
+        A (x, y, first row, end row, first column, end column) tuple for each tile
+        overlapping the image
+    """
+    rows, cols = shape
+    lon_step, lat_step = (float(step) for step in steps)
+
+    def edges(start, pixel, size, step, origin, direction):
+        # Index of the tiles covering the image and the image pixel where each one starts
+        first = int(np.floor(direction*(start - origin)/step))
+        last = int(np.ceil(direction*(start + direction*pixel*size - origin)/step))
+        pixels = np.rint((origin + direction*step*np.arange(first, last + 1) - start)*direction/pixel)
+        return first, np.clip(pixels, 0, size).astype(int)
+
+    first_x, col_edges = edges(min_lon, pixel_size[0], cols, lon_step, -180.0, 1)
+    first_y, row_edges = edges(max_lat, pixel_size[1], rows, lat_step, 90.0, -1)
+
+    windows = []
+    for j, (r0, r1) in enumerate(zip(row_edges[:-1], row_edges[1:])):
+        for i, (c0, c1) in enumerate(zip(col_edges[:-1], col_edges[1:])):
+            if r1 > r0 and c1 > c0:
+                windows.append((first_x + i, first_y + j, int(r0), int(r1), int(c0), int(c1)))
+    return windows
+
+
+def level_factor(ppd, level):
+    """
+    Returns the integer block size reducing an image at ppd to a level at a
+    coarser ppd, raises ValueError if the level does not evenly divide ppd
+    """
+    factor = ppd / level if level > 0 else 0
+    if factor < 1 or not np.isclose(factor, round(factor)):
+        raise ValueError(f'Level ppd {level} must evenly divide the image ppd {ppd}')
+    return int(round(factor))
+
+
+def block_reduce(array, factor, method='mean'):
+    """
+    Reduces an image by combining each factor by factor block of pixels into one.
+    The bottom and right edges are padded with NaN to a whole number of blocks
+    so the top left corner of the image stays in place.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        A 2D array of values, NaN where there is no data
+    factor : int
+        Block size
+    method : string
+        "mean" averages the values of a block, "mode" takes its most common value,
+        the smallest of equally common ones. NaN values are ignored.
+
+    Returns
+    -------
+    numpy.ndarray
+        The reduced array, NaN for blocks without data
+    """
+    if method not in ('mean', 'mode'):
+        raise ValueError(f'Unknown level reduction {method}, expected mean or mode')
+    if factor == 1:
+        return array
+
+    rows, cols = array.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    padded = np.full((out_rows*factor, out_cols*factor), np.nan)
+    padded[:rows, :cols] = array
+    blocks = padded.reshape(out_rows, factor, out_cols, factor).swapaxes(1, 2).reshape(out_rows, out_cols, factor*factor)
+
+    if method == 'mean':
+        counts = np.count_nonzero(~np.isnan(blocks), axis=2)
+        sums = np.nansum(blocks, axis=2)
+        return np.where(counts > 0, sums/np.maximum(counts, 1), np.nan)
+
+    # Length of the run of equal values ending at each position of the sorted blocks, NaN sort last
+    blocks = np.sort(blocks, axis=2)
+    position = np.arange(factor*factor)
+    new_run = np.ones(blocks.shape, dtype=bool)
+    new_run[..., 1:] = blocks[..., 1:] != blocks[..., :-1]
+    run_start = np.maximum.accumulate(np.where(new_run, position, 0), axis=2)
+    run_length = np.where(np.isnan(blocks), 0, position - run_start + 1)
+    mode = np.take_along_axis(blocks, np.argmax(run_length, axis=2)[..., np.newaxis], axis=2)[..., 0]
+    return mode
+
+
+def calc_binned_lut(lon_array, lat_array, region, rows, cols):
+    """
+    Computes the look-up table between data points and a regular lon/lat
+    image grid by direct binning. The image pixels are spaced evenly across
+    the region, so the nearest pixel of each point is found arithmetically
+    instead of querying a KD-tree built over every pixel.
+    Parameters
+    ----------
+    lon_array : numpy.ndarray
+        An array of longitudinal values
+    lat_array : numpy.ndarray
+        An array of latitude values
+    region : Region
+        The extents of the image
+    rows : int
+        Number of rows in the image grid
+    cols : int
+        Number of columns in the image grid
+    Returns
+    -------
+    numpy.ndarray
+        Index of the nearest image pixel for each data point, -1 where
+        the point has no valid coordinates
+    """
+    lons = ma.filled(ma.masked_invalid(lon_array), np.nan).ravel()
+    lats = ma.filled(ma.masked_invalid(lat_array), np.nan).ravel()
+
+    x_size = (region.max_lon - region.min_lon) / cols
+    y_size = (region.max_lat - region.min_lat) / rows
+
+    # -180 and 180 are the same meridian so the columns of a global image wrap around
+    col_index = axis_bins(lons, region.min_lon, x_size, cols, periodic=np.isclose(region.max_lon - region.min_lon, 360))
+    row_index = axis_bins(lats, region.min_lat, y_size, rows)
+
+    lut = row_index * cols + col_index
+    lut[(col_index < 0) | (row_index < 0)] = -1
+    return lut
+
+
+def axis_bins(coords, start, size, count, periodic=False):
+    """
+    Computes the nearest image column or row of coordinates along one axis.
+    Image grid points sit at start + index * size, so the nearest one is the
+    rounded index.
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        Coordinate values, NaN where invalid
+    start : float
+        Coordinate of the first image column or row
+    size : float
+        Pixel size along the axis
+    count : int
+        Number of image columns or rows
+    periodic : bool
+        Whether the axis wraps around instead of clamping to the edges
+    Returns
+    -------
+    numpy.ndarray
+        Index of the nearest column or row, -1 where the coordinate is invalid
+    """
+    index = np.rint((coords - start) / size)
+    valid = np.isfinite(index)
+    index = np.where(valid, index, 0).astype(np.int64)
+    if periodic:
+        index %= count
+    else:
+        np.clip(index, 0, count - 1, out=index)
+    index[~valid] = -1
+    return index
+
+
+def nearest_axis_indices(coords, targets, period=None):
+    """
+    Finds the nearest source coordinate of each target along one axis of a
+    rectilinear grid with a binary search over the sorted coordinates.
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        The 1-D source coordinates in any order, masked or NaN where invalid
+    targets : numpy.ndarray
+        The coordinates of the image columns or rows
+    period : float
+        Optional period of the axis, 360 for longitudes. When the coordinates
+        cover a whole period the nearest one is searched across the wrap
+    Returns
+    -------
+    numpy.ndarray
+        Index into coords of the nearest coordinate of each target, -1 where
+        the target is more than half a grid spacing outside the coordinates
+    """
+    coords = ma.filled(ma.masked_invalid(ma.asarray(coords, dtype=np.float64)), np.nan)
+    targets = np.asarray(targets, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(coords))
+    if valid.size == 0:
+        return np.full(targets.shape, -1, dtype=np.int64)
+
+    order = valid[np.argsort(coords[valid], kind='stable')]
+    values = coords[order]
+    half_spacing = np.median(np.diff(values)) / 2 if values.size > 1 else 0.0
+    periodic = period is not None and values.size > 1 and values[-1] - values[0] + 3 * half_spacing >= period
+    if periodic:
+        values = np.concatenate([values[-1:] - period, values, values[:1] + period])
+        order = np.concatenate([order[-1:], order, order[:1]])
+    if values.size == 1:
+        nearest = np.zeros(targets.shape, dtype=np.int64)
+    else:
+        upper = np.clip(np.searchsorted(values, targets), 1, values.size - 1)
+        nearest = np.where(targets - values[upper - 1] <= values[upper] - targets, upper - 1, upper)
+
+    index = order[nearest]
+    if not periodic:
+        index[(targets < values[0] - half_spacing) | (targets > values[-1] + half_spacing)] = -1
+    return index
+
+
 def create_world_file(x_size, y_size, max_lat, min_lon):
     """
     Creates an Esri world file for georeferencing.
@@ -835,9 +2347,97 @@ def create_world_file(x_size, y_size, max_lat, min_lon):
     return wld_string
 
 
+class Palette():  # pylint: disable=too-few-public-methods
+    """
+    Colors of a JSON palette parsed once and kept as a compact uint8 array,
+    along with the matplotlib colormap built from them
+    """
+
+    def __init__(self, name, colors):
+        self.name = name
+        self.colors = colors
+        self.colormap = col.ListedColormap(colors / 255, name)
+
+
+# Parsed palettes keyed by (palette_name, hash of the palette file, alpha), shared across TIG runs
+# in a process, so palettes downloaded again to a new directory are not parsed again
+_palette_cache = {}
+
+
+def load_palette(palette_dir, palette_name, alpha):
+    """
+    Returns a parsed palette, parsing the JSON palette file only when its contents are new.
+    Parameters
+    ----------
+    palette_dir : string
+        Path to directory with palette files
+    palette_name : string
+        The name of the colormap
+    alpha : bool
+        Whether or not the colors should contain an alpha channel
+    Returns
+    -------
+    Palette
+    """
+    palette_file = f'{palette_dir}/{palette_name}.json'
+    with open(palette_file, 'rb') as cmap_file:
+        content = cmap_file.read()
+
+    key = (palette_name, hashlib.sha256(content).hexdigest(), alpha)
+    palette = _palette_cache.get(key)
+    if palette is not None:
+        return palette
+
+    values = json.loads(content)['Palette']['values']['value']
+
+    colors = np.fromstring(','.join(y['color'] for y in values), dtype=np.uint8, sep=',').reshape(len(values), 3)
+    if alpha:
+        colors = np.hstack([colors, np.full((len(values), 1), 255, dtype=np.uint8)])
+
+    palette = Palette(palette_name, colors)
+    if palette_name not in matplotlib.colormaps:
+        matplotlib.colormaps.register(cmap=palette.colormap)
+    _palette_cache[key] = palette
+    return palette
+
+
+def prewarm(palette_dir=None, palette_names=(), alpha=True):
+    """
+    Imports the modules used to render images and parses palettes ahead of the
+    first granule. Meant to run once per process before any work arrives, e.g.
+    in the init phase of a Lambda container or before forking workers, which
+    then inherit the loaded modules and palettes.
+    Parameters
+    ----------
+    palette_dir : string
+        Optional path to directory with palette files
+    palette_names : iterable
+        Names of the palettes to parse
+    alpha : bool
+        Whether or not the palettes should contain an alpha channel
+    Returns
+    -------
+    dict
+        Seconds spent importing each module of PREWARM_MODULES, 0 when it was already imported
+    """
+    timings = {}
+    for name in PREWARM_MODULES:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = round(time.perf_counter() - start, 3)
+    for palette_name in palette_names:
+        load_palette(palette_dir, palette_name, alpha)
+    return timings
+
+
+def clear_palette_cache():
+    """Forgets every parsed palette so palette files are read again"""
+    _palette_cache.clear()
+
+
 def load_json_palette(palette_dir, palette_name, alpha):
     """
-    Parses and registers a JSON color palette file.
+    Parses a JSON color palette file into a colormap, palettes are cached per process.
     Parameters
     ----------
     palette_dir : string
@@ -850,28 +2450,100 @@ def load_json_palette(palette_dir, palette_name, alpha):
     -------
     Colormap
     """
+    return load_palette(palette_dir, palette_name, alpha).colormap
 
-    palette_file = f'{palette_dir}/{palette_name}.json'
-    with open(palette_file) as cmap_file:
-        palette = json.load(cmap_file)
 
-    if alpha:
-        # pylint: disable=R1728
-        colors = [tuple([int(x)/255 for x in (str(y['color']+',255')).split(',')])
-                  for y in palette['Palette']['values']['value']]
-    else:
-        # pylint: disable=R1728
-        colors = [tuple([int(x) for x in y['color'].split(',')])
-                  for y in palette['Palette']['values']['value']]
+def colormap_table(colormap):
+    """
+    Builds a uint8 RGBA lookup table for a colormap.
+    Parameters
+    ----------
+    colormap : Colormap
+        A registered matplotlib Colormap or its name
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (N + 3, 4) with the N colors of the colormap followed
+        by its under, over and bad colors
+    """
+    cmap = colormap if isinstance(colormap, col.Colormap) else matplotlib.colormaps[colormap]
+    colors = np.vstack([cmap(np.arange(cmap.N)), cmap([-1.0, 2.0, np.nan])])
+    return np.rint(colors * 255).astype(np.uint8)
 
-    cmap = col.ListedColormap(colors, palette_name)
-    try:
-        matplotlib.colormaps.register(cmap=cmap)
-    except ValueError:
-        # palette register via other images
-        pass
 
-    return matplotlib.colormaps[palette_name]
+def colormap_indices(vals, min_val, max_val, n_colors):
+    """
+    Maps data values to rows of a colormap table, binning them the same way
+    as calling a matplotlib colormap with the normalized values.
+    Parameters
+    ----------
+    vals : numpy.ndarray
+        Array of data values
+    min_val : float
+        The minimum data value for the colormap
+    max_val : float
+        The maximum data value for the colormap
+    n_colors : int
+        Number of colors in the colormap
+    Returns
+    -------
+    numpy.ndarray
+        Indices into a table laid out like colormap_table, values below,
+        above and without data index the under, over and bad rows
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = (vals - min_val) / (max_val - min_val) * n_colors
+        scaled[scaled == n_colors] = n_colors - 1
+        index = scaled.astype(np.int64)
+    index[scaled < 0] = n_colors
+    index[scaled >= n_colors] = n_colors + 1
+    index[np.isnan(scaled)] = n_colors + 2
+    return index
+
+
+def write_indexed_png(output_location, vals, min_val, max_val, colormap):
+    """
+    Writes a 2D array of data values as an 8-bit paletted PNG. Values are
+    mapped straight to palette indices and no data gets a fully transparent
+    palette entry, so the image looks the same as one written by matplotlib imsave.
+    Parameters
+    ----------
+    output_location : string
+        Path of the PNG file
+    vals : numpy.ndarray
+        A 2D array of data values, NaN where there is no data
+    min_val : float
+        The minimum data value for the colormap
+    max_val : float
+        The maximum data value for the colormap
+    colormap : Colormap
+        A matplotlib Colormap
+    Returns
+    -------
+    bool
+        False if the colormap has more than 256 distinct colors and nothing was written
+    """
+    n_colors = colormap.N
+    table = np.vstack([colormap(np.arange(n_colors), bytes=True),
+                       colormap([-1.0, 2.0, np.nan], bytes=True)])
+
+    # Under and over colors usually repeat the first and last colors
+    palette, remap = np.unique(table, axis=0, return_inverse=True)
+    if len(palette) > 256:
+        return False
+
+    if min_val == max_val:
+        # matplotlib maps everything to the first color when the range is empty
+        index = np.zeros(vals.shape, dtype=np.int64)
+    else:
+        index = colormap_indices(np.asarray(vals, dtype=np.float64), min_val, max_val, n_colors)
+    index = remap.ravel()[index].astype(np.uint8)
+
+    rows, cols = index.shape
+    image = Image.frombuffer('P', (cols, rows), np.ascontiguousarray(index), 'raw', 'P', 0, 1)
+    image.putpalette(palette[:, :3].tobytes(), rawmode='RGB')
+    image.save(output_location, format='png', transparency=palette[:, 3].tobytes())
+    return True
 
 
 def vals_to_rgba(vals, min_val, max_val, colormap, transparency=True, no_data=None):
@@ -896,36 +2568,42 @@ def vals_to_rgba(vals, min_val, max_val, colormap, transparency=True, no_data=No
     list
         List of values as Red, Green, Blue, and Alpha (if true)
     """
-    cmap = plt.get_cmap(colormap)
+    table = colormap_table(colormap)
+    n_colors = table.shape[0] - 3
     max_val = float(max_val)
     min_val = float(min_val)
-    drange = max_val - min_val
-    output = np.zeros((vals.size, 4 if transparency else 3), dtype=np.uint8)
-    for i, val in enumerate(vals):
-        val = float(val)
-        if no_data is not None:
-            no_data = float(no_data)
-        if val > max_val:
-            val = max_val
-        if val < min_val and no_data != val:
-            val = min_val
-
-        if val == no_data:
-            alpha = 0
-        else:
-            alpha = 255
 
-        norm_val = (val - min_val) / (drange)
-        (float_r, float_g, float_b, _float_a) = cmap(norm_val)
+    vals = np.asarray(vals, dtype=np.float64).ravel()
+    vals = np.where(vals > max_val, max_val, vals)
+    if no_data is None:
+        no_data_mask = np.zeros(vals.shape, dtype=bool)
+    else:
+        no_data_mask = vals == float(no_data)
+    vals = np.where((vals < min_val) & ~no_data_mask, min_val, vals)
 
-        int_r = int(round(float_r * 255))
-        int_g = int(round(float_g * 255))
-        int_b = int(round(float_b * 255))
-        if transparency:
-            output[i] = [int_r, int_g, int_b, alpha]
-        else:
-            output[i] = [int_r, int_g, int_b]
-    return output
+    index = colormap_indices(vals, min_val, max_val, n_colors)
+    output = table[index]
+    output[:, 3] = np.where(no_data_mask, 0, 255)
+    return output if transparency else output[:, :3]
+
+
+def chunked_min_max(data_array):
+    """
+    Returns the min and max of a variable read in blocks of rows of about
+    SCAN_CHUNK_SIZE values, so the whole variable is never loaded at once.
+    NaN values propagate like np.amin and np.amax.
+    """
+    if data_array.ndim == 0 or data_array.size <= SCAN_CHUNK_SIZE:
+        values = data_array.values
+        return np.amin(values), np.amax(values)
+
+    chunk_rows = max(1, SCAN_CHUNK_SIZE // int(np.prod(data_array.shape[1:])))
+    mins, maxs = [], []
+    for start in range(0, data_array.shape[0], chunk_rows):
+        values = data_array[start:start + chunk_rows].values
+        mins.append(np.amin(values))
+        maxs.append(np.amax(values))
+    return np.amin(mins), np.amax(maxs)
 
 
 def is_360(lon_var, scale, offset):
@@ -947,8 +2625,9 @@ def is_360(lon_var, scale, offset):
     valid_min = lon_var.attrs.get('valid_min', None)
 
     if valid_min is None or valid_min > 0:
-        var_min = remove_scale_offset(np.amin(lon_var.values), scale, offset)
-        var_max = remove_scale_offset(np.amax(lon_var.values), scale, offset)
+        var_min, var_max = chunked_min_max(lon_var)
+        var_min = remove_scale_offset(var_min, scale, offset)
+        var_max = remove_scale_offset(var_max, scale, offset)
 
         if var_min < 0:
             return False
@@ -0,0 +1,94 @@
+"""
+==============
+test_cli.py
+==============
+
+Test the TIG command line.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+from podaac.tig import cli
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+SWOT_FILE = f'{TEST_DIR}/input/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+SWOT_CONFIG = f'{TEST_DIR}/configs/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+
+
+@pytest.fixture
+def work_dir():
+    path = f'{TEST_DIR}/output/cli'
+    os.makedirs(path, exist_ok=True)
+    yield path
+    shutil.rmtree(path)
+
+
+def test_expand_inputs(work_dir):
+    os.makedirs(f'{work_dir}/granules')
+    for name in ('b.nc', 'a.nc'):
+        shutil.copy(SWOT_FILE, f'{work_dir}/granules/{name}')
+    with open(f'{work_dir}/granules.txt', 'w') as list_f:
+        list_f.write(f'{work_dir}/granules/b.nc\n\n{work_dir}/granules/*.nc\n')
+
+    granules = [f'{work_dir}/granules/a.nc', f'{work_dir}/granules/b.nc']
+    assert cli.expand_inputs([f'{work_dir}/granules']) == granules
+    assert cli.expand_inputs([f'{work_dir}/granules/*.nc']) == granules
+    assert cli.expand_inputs([f'{work_dir}/granules.txt']) == granules[1:] + granules
+    assert cli.expand_inputs([SWOT_FILE]) == [SWOT_FILE]
+
+    # Other files in a directory are skipped and unknown files are kept as granules
+    with open(f'{work_dir}/granules/tig_summary.jsonl', 'w') as summary_f:
+        summary_f.write('{}\n')
+    with open(f'{work_dir}/granule.h5', 'wb') as binary_f:
+        binary_f.write(b'\xff\xfe\x00binary')
+    assert cli.expand_inputs([f'{work_dir}/granules']) == granules
+    assert cli.expand_inputs([f'{work_dir}/granule.h5']) == [f'{work_dir}/granule.h5']
+
+    # A list naming itself is expanded once
+    with open(f'{work_dir}/self.lst', 'w') as list_f:
+        list_f.write(f'{work_dir}/self.lst\n{work_dir}/granules/a.nc\n')
+    assert cli.expand_inputs([f'{work_dir}/self.lst']) == granules[:1]
+
+
+def test_batch(work_dir):
+    missing_file = f'{work_dir}/missing.nc'
+    args = ['tig', '--input_file', SWOT_FILE, missing_file, '--output_dir', f'{work_dir}/images',
+            '--config_file', SWOT_CONFIG, '--palette_dir', f'{TEST_DIR}/palettes', '--jobs', '2']
+
+    # A failed granule is reported without stopping the others
+    with mock.patch.object(sys, 'argv', args), pytest.raises(SystemExit) as exit_info:
+        cli.main()
+    assert exit_info.value.code == 1
+
+    with open(f'{work_dir}/images/tig_summary.jsonl') as summary_f:
+        summaries = {summary['granule']: summary for summary in map(json.loads, summary_f)}
+    assert summaries[SWOT_FILE]['status'] == 'success'
+    assert all(os.path.exists(image) for image in summaries[SWOT_FILE]['images'])
+    assert summaries[missing_file]['status'] == 'error'
+    assert summaries[SWOT_FILE]['seconds'] >= 0
+
+
+def test_batch_bad_setup(work_dir):
+    args = [sys.executable, '-m', 'podaac.tig.cli', '--input_file', SWOT_FILE, SWOT_FILE,
+            '--output_dir', f'{work_dir}/images', '--config_file', SWOT_CONFIG,
+            '--palette_dir', f'{work_dir}/missing_palettes', '--jobs', '2']
+
+    # A missing palette fails the batch instead of restarting pool workers forever
+    result = subprocess.run(args, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 1
+    assert 'missing_palettes' in result.stderr
+
+    # A worker that could not load the palettes reports it for each granule
+    cli.init_worker(SWOT_CONFIG, f'{work_dir}/missing_palettes', f'{work_dir}/images')
+    try:
+        summary = cli.render_granule(SWOT_FILE)
+    finally:
+        cli._worker.clear()
+    assert summary['status'] == 'error'
+    assert summary['error'].startswith('Could not set up the worker')
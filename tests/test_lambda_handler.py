@@ -2,6 +2,8 @@
 
 import json
 import os
+import shutil
+import time
 import boto3
 import pytest
 from jsonschema import validate
@@ -10,6 +12,27 @@ from podaac.lambda_handler import lambda_handler
 from moto import mock_aws
 from mock import patch, Mock
 
+
+@pytest.fixture(autouse=True)
+def temp_dir(tmp_path, monkeypatch):
+    """Cleans and caches in a scratch folder instead of /tmp, with an empty file cache"""
+    path = tmp_path / 'tmp'
+    path.mkdir()
+    monkeypatch.setattr(lambda_handler, 'TEMP_DIR', str(path))
+    monkeypatch.setattr(lambda_handler, 'CACHE_DIR', str(path / 'tig-cache'))
+    lambda_handler.get_file_cache.cache_clear()
+    yield path
+    lambda_handler.get_file_cache.cache_clear()
+
+
+@pytest.fixture
+def work_dir():
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'output', 'lambda_handler')
+    os.makedirs(path, exist_ok=True)
+    yield path
+    shutil.rmtree(path)
+
+
 file_schema = {
   "type": "array",
   "items": {
@@ -138,10 +161,10 @@ def test_get_config():
     image_generator.clean_all()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_get_config_url(mocked_get):
     """Test lambda handler function upload_file_to_s3 uploads files to s3"""
-    mocked_get.return_value = Mock(status_code=201, content=b'hello world')
+    mocked_get.return_value = Mock(status_code=201, content=b'hello world', headers={})
     os.environ["CONFIG_URL"] = "https://hitide.podaac.sit.earthdatacloud.nasa.gov/dataset-configs"
     image_generator = lambda_handler.ImageGenerator(input={})
     image_generator.config = {
@@ -185,7 +208,7 @@ class Context:
 
 
 @mock_aws
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_lambda_handler_cumulus(mocked_get):
     """Test lambda handler to run through cumulus handler"""
 
@@ -195,7 +218,7 @@ def test_lambda_handler_cumulus(mocked_get):
 
     with open(palette_file) as palette_json_file:
         palette_data = json.load(palette_json_file)
-        mocked_get.return_value = Mock(status_code=200, content=json.dumps(palette_data).encode('utf-8'))
+        mocked_get.return_value = Mock(status_code=200, content=json.dumps(palette_data).encode('utf-8'), headers={})
 
     bucket = "test-prefix-protected-test"
     aws_s3 = boto3.resource('s3', region_name='us-east-1')
@@ -250,3 +273,195 @@ def test_lambda_handler_cumulus(mocked_get):
                 key = file.get('key')
                 # test if file in s3 if not then test fails
                 aws_s3.Object(bucket, key).load()
+
+
+def test_partition_variables():
+    """Test variables are split into contiguous lists that keep their order"""
+    variables = [{'id': str(i)} for i in range(7)]
+
+    partitions = lambda_handler.partition_variables(variables, 3)
+    assert [len(partition) for partition in partitions] == [3, 2, 2]
+    assert [var for partition in partitions for var in partition] == variables
+
+    assert lambda_handler.partition_variables(variables, 1) == [variables]
+
+
+@patch.dict(os.environ, {"TIG_PROCESSES": "4"})
+def test_get_process_count():
+    """Test process count comes from the environment and is capped by the variables"""
+    assert lambda_handler.get_process_count(10) == 4
+    assert lambda_handler.get_process_count(2) == 2
+    assert lambda_handler.get_process_count(0) == 1
+
+
+def test_init_timings():
+    """Test the container is warmed up once on import with its timings recorded"""
+    assert set(lambda_handler.INIT_TIMINGS) == set(lambda_handler.tig.PREWARM_MODULES) | {'total'}
+
+
+@mock_aws
+@patch.dict(os.environ, {"TIG_UPLOAD_WORKERS": "3"})
+def test_upload_images(tmp_path):
+    """Test images are uploaded concurrently in order and the first error is raised"""
+    bucket = "test-prefix-public-test"
+    aws_s3 = boto3.resource('s3', region_name='us-east-1')
+    aws_s3.create_bucket(Bucket=bucket)
+
+    image_generator = lambda_handler.ImageGenerator(input={})
+    image_generator.config = {'buckets': {'public': {'name': bucket}}, 'collection': {'files': []}}
+    file_ = {'key': 'granules/granule.nc'}
+    image_list = []
+    for index in range(7):
+        image_file = tmp_path / f'granule.var{index}.png'
+        image_file.write_bytes(b'png' * index)
+        image_list.append({'image_file': str(image_file), 'variable': f'var{index}', 'group': None})
+
+    assert lambda_handler.get_upload_workers(len(image_list)) == 3
+    assert lambda_handler.get_upload_workers(2) == 2
+    uploaded_files = image_generator._upload_images(file_, image_list)
+    assert [file['description'] for file in uploaded_files] == [f'var{index}' for index in range(7)]
+    for index, file in enumerate(uploaded_files):
+        assert file['key'] == f'granules/granule.var{index}.png'
+        assert aws_s3.Object(bucket, file['key']).get()['Body'].read() == b'png' * index
+
+    image_list.append({'image_file': str(tmp_path / 'missing.png'), 'variable': 'missing', 'group': None})
+    with pytest.raises(FileNotFoundError):
+        image_generator._upload_images(file_, image_list)
+
+
+@mock_aws
+@patch.dict(os.environ, {"TIG_INPUT_MODE": "ranged"})
+def test_open_input_ranged():
+    """Test netCDF4 granules are read from S3 in the ranged input mode and other files are downloaded"""
+    bucket = "test-prefix-protected-test"
+    aws_s3 = boto3.resource('s3', region_name='us-east-1')
+    aws_s3.create_bucket(Bucket=bucket)
+
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    nc_file = f'{test_dir}/input/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+    with open(nc_file, 'rb') as data:
+        aws_s3.Bucket(bucket).put_object(Key='granules/granule.nc', Body=data)
+    aws_s3.Bucket(bucket).put_object(Key='granules/granule_netcdf3.nc', Body=b'CDF\x01' + bytes(100))
+
+    image_generator = lambda_handler.ImageGenerator(input={})
+    assert image_generator._open_input({'bucket': bucket, 'key': 'granules/granule.nc'}) == \
+        f's3://{bucket}/granules/granule.nc'
+    local_file = image_generator._open_input({'bucket': bucket, 'key': 'granules/granule_netcdf3.nc'})
+    assert os.path.isfile(local_file)
+    image_generator.clean_all()
+
+
+@mock_aws
+def test_remote_file_cache(work_dir):
+    """Test configs and palettes are reused within the ttl and revalidated after it"""
+    cache = lambda_handler.RemoteFileCache(f'{work_dir}/cache', ttl=60)
+    url = 'https://example.com/palettes/palette.json'
+
+    with patch('requests.Session.get') as mocked_get:
+        mocked_get.return_value = Mock(status_code=200, content=b'palette', headers={'ETag': '"v1"'})
+        assert cache.fetch_url(url) == b'palette'
+        assert cache.fetch_url(url) == b'palette'
+        assert mocked_get.call_count == 1
+
+        # A new process reads the disk cache, expired files are revalidated
+        cache = lambda_handler.RemoteFileCache(f'{work_dir}/cache', ttl=0)
+        mocked_get.return_value = Mock(status_code=304, content=b'', headers={})
+        assert cache.fetch_url(url) == b'palette'
+        assert mocked_get.call_args.kwargs['headers'] == {'If-None-Match': '"v1"'}
+
+        mocked_get.return_value = Mock(status_code=200, content=b'new palette', headers={'ETag': '"v2"'})
+        assert cache.fetch_url(url) == b'new palette'
+
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='internal-bucket')
+    s3_client.put_object(Bucket='internal-bucket', Key='dataset-config/config.cfg', Body=b'config')
+    assert cache.fetch_s3('s3://internal-bucket/dataset-config/config.cfg', s3_client) == b'config'
+    assert cache.fetch_s3('s3://internal-bucket/dataset-config/config.cfg', s3_client) == b'config'
+    s3_client.put_object(Bucket='internal-bucket', Key='dataset-config/config.cfg', Body=b'new config')
+    assert cache.fetch_s3('s3://internal-bucket/dataset-config/config.cfg', s3_client) == b'new config'
+
+
+def test_clean_tmp_keeps_cache(temp_dir):
+    """Test the config and palette cache survives the tmp cleaning"""
+    os.makedirs(lambda_handler.CACHE_DIR, exist_ok=True)
+    (temp_dir / 'granule.nc').write_bytes(b'granule')
+    lambda_handler.clean_tmp()
+    assert os.listdir(temp_dir) == ['tig-cache']
+
+
+@mock_aws
+@patch.dict(os.environ, {"TIG_PREFETCH": "1", "TIG_INPUT_MODE": "download"})
+def test_process_pipeline(work_dir):
+    """Test files are fetched ahead, rendered and uploaded in order with their local files removed"""
+    bucket = "test-prefix-public-test"
+    aws_s3 = boto3.resource('s3', region_name='us-east-1')
+    aws_s3.create_bucket(Bucket=bucket)
+    for index in range(3):
+        aws_s3.Bucket(bucket).put_object(Key=f'granules/granule{index}.nc', Body=b'nc')
+
+    image_generator = lambda_handler.ImageGenerator(input={}, path=work_dir)
+    image_generator.config = {'buckets': {'public': {'name': bucket}}, 'collection': {'files': []}}
+    work = [(f'granule{index}', {'bucket': bucket, 'key': f'granules/granule{index}.nc', 'type': 'data'})
+            for index in range(3)]
+    work.insert(1, ('granule0', {'bucket': bucket, 'key': 'granules/granule0.cmr.json', 'type': 'metadata'}))
+    config_file = f'{work_dir}/config.cfg'
+    with open(config_file, 'w') as config:
+        json.dump({'imgVariables': [{'id': 'sst'}]}, config)
+
+    fetched_ahead = []
+
+    def generate_images(processes, local_file, path, granule_id):
+        # The next file is fetched while this one renders
+        deadline = time.time() + 5
+        while granule_id == 'granule0' and time.time() < deadline and not fetched_ahead:
+            fetched_ahead.extend(path for _, _, files in os.walk(work_dir) for path in files if path == 'granule1.nc')
+            time.sleep(0.01)
+        os.makedirs(path)
+        image_file = f'{path}/{granule_id}.sst.png'
+        with open(image_file, 'wb') as image:
+            image.write(granule_id.encode())
+        return [{'image_file': image_file, 'variable': 'sst', 'group': None}]
+
+    with patch.object(image_generator, '_generate_images', side_effect=generate_images):
+        results = image_generator.process_pipeline(work, config_file)
+
+    assert results[1] is None
+    assert [result[0]['fileName'] for result in results if result] == [f'granule{index}.sst.png' for index in range(3)]
+    assert fetched_ahead == ['granule1.nc']
+    for index in range(3):
+        assert aws_s3.Object(bucket, f'granules/granule{index}.sst.png').get()['Body'].read() == f'granule{index}'.encode()
+    assert [files for _, _, files in os.walk(work_dir) if files] == [['config.cfg']]
+
+
+@mock_aws
+@patch.dict(os.environ, {"TIG_PROCESSES": "1", "TIG_INPUT_MODE": "download"})
+def test_process_pipeline_shared_image_names(work_dir):
+    """Test files of a granule with the same image names don't overwrite images that are still uploading"""
+    bucket = "test-prefix-public-test"
+    aws_s3 = boto3.resource('s3', region_name='us-east-1')
+    aws_s3.create_bucket(Bucket=bucket)
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    for index in range(2):
+        aws_s3.Bucket(bucket).upload_file(f'{test_dir}/input/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc',
+                                          f'granules/{index}/granule.nc')
+    shutil.copy(f'{test_dir}/palettes/paletteMedspirationIndexed.json', work_dir)
+    config_file = f'{test_dir}/configs/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+
+    image_generator = lambda_handler.ImageGenerator(input={}, path=work_dir)
+    image_generator.config = {'buckets': {'public': {'name': bucket}}, 'collection': {'files': []}}
+    work = [('granule', {'bucket': bucket, 'key': f'granules/{index}/granule.nc', 'type': 'data'}) for index in range(2)]
+
+    upload_file_to_s3 = image_generator.upload_file_to_s3
+
+    def slow_upload(filename, uri):
+        time.sleep(1)
+        upload_file_to_s3(filename, uri)
+
+    with patch.object(image_generator, 'upload_file_to_s3', side_effect=slow_upload):
+        results = image_generator.process_pipeline(work, config_file)
+
+    assert [[file['key'] for file in result] for result in results] == \
+        [[f'granules/{index}/granule.data_01.ku.ssha.png'] for index in range(2)]
+    for index in range(2):
+        assert aws_s3.Object(bucket, f'granules/{index}/granule.data_01.ku.ssha.png').get()['Body'].read().startswith(b'\x89PNG')
+    assert not os.path.exists(f'{work_dir}/images/0') and not os.path.exists(f'{work_dir}/images/1')
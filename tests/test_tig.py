@@ -5,18 +5,28 @@ test_tig.py
 
 Test TIG functionality.
 """
+import json
 import logging
 import os
 import shutil
+import subprocess
+import sys
 import unittest
 from typing import Union, Tuple, Optional
+from unittest import mock
 
+import boto3
 import cv2
 import filecmp
+import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 from skimage.metrics import structural_similarity as ssim
 
+import pygeogrids.grids as grids
+import xarray as xr
+from moto import mock_aws
+
 from podaac.tig import tig
 
 def images_are_similar(
@@ -184,5 +194,573 @@ class TestTIG(unittest.TestCase):
             image_file = f'{image_dir}/{filename}'
             self.assertTrue(images_are_similar(output_file, image_file), f"{output_file} and {image_file} are not similar")
 
+    def test_lut_computed_once_per_resolution(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/lut_cache'
+
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        variable = config['imgVariables'][0]
+        variables = [
+            variable,
+            dict(variable, id='data_01/ku/swh_ocean'),
+            dict(variable, id='data_01/ku/sig0_ocean', ppd=2),
+        ]
+
+        image_gen = tig.TIG(input_file, output_dir, config_file, self.palette_dir, variables=variables)
+        with mock.patch.object(grids.BasicGrid, 'calc_lut', autospec=True,
+                               side_effect=grids.BasicGrid.calc_lut) as calc_lut:
+            images = image_gen.generate_images()
+
+        self.assertEqual(len(images), 3)
+        self.assertEqual(calc_lut.call_count, 2)
+
+    def test_dataset_session_opens_each_group_once(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/dataset_session'
+
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        variable = config['imgVariables'][0]
+        variables = [variable, dict(variable, id='data_01/ku/swh_ocean')]
+
+        image_gen = tig.TIG(input_file, output_dir, config_file, self.palette_dir, variables=variables)
+        with mock.patch.object(tig.xr, 'open_dataset', wraps=xr.open_dataset) as open_dataset:
+            image_gen.generate_images()
+
+        # One open for the coordinate group and one for the variable group
+        self.assertEqual(open_dataset.call_count, 2)
+        self.assertEqual(image_gen.dataset_session._datasets, {})
+
+    def test_binned_lut_matches_pygeogrids(self):
+        rng = np.random.default_rng(0)
+        lons = rng.uniform(-180, 180, 20000)
+        lats = rng.uniform(-80, 80, 20000)
+        rows, cols = 180, 360
+        region = tig.Region([-90, 90, -180, 180])
+
+        lon_grid, lat_grid = np.meshgrid(np.arange(-180, 180, 1.0), np.arange(-90, 90, 1.0))
+        image_grid = grids.BasicGrid(lon_grid.flatten(), lat_grid.flatten(), shape=(rows, cols))
+        expected = grids.BasicGrid(lons, lats).calc_lut(image_grid)
+
+        lut = tig.calc_binned_lut(lons, lats, region, rows, cols)
+        self.assertGreater(np.mean(lut == expected), 0.999)
+
+        # Points without coordinates are left out of the image
+        lut = tig.calc_binned_lut(np.array([np.nan, 179.9]), np.array([0.0, 0.0]), region, rows, cols)
+        np.testing.assert_array_equal(lut, [-1, 90 * cols])
+
+    def test_binned_gridding_invalid_coordinates(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        image_gen = tig.TIG(input_file, self.output_dir, config_file, self.palette_dir, gridding='binning')
+        image_gen.region = tig.Region([0, 2, 0, 4])
+
+        # Values keep their pixels when points without coordinates are dropped
+        lons = np.ma.masked_invalid([np.nan, 1.0, 2.0, np.nan, 3.0])
+        lats = np.ma.masked_invalid([0.0, 0.0, 1.0, 1.0, np.nan])
+        values = np.ma.array([10.0, 11.0, 12.0, 13.0, 14.0])
+        output_vals = image_gen.generate_image_output(values, lons, lats, -99.0, 2, 4)
+        np.testing.assert_array_equal(output_vals, [-99, 11, -99, -99, -99, -99, 12, -99])
+
+    def test_unknown_gridding_engine(self):
+        config_file = f'{self.config_dir}/PODAAC-CYGNS-C2H10.cfg'
+        with self.assertRaises(ValueError):
+            tig.TIG('input.nc', self.output_dir, config_file, self.palette_dir, gridding='kdtree')
+
+    def test_scan_coordinates(self):
+        lons = np.ma.masked_invalid(np.array([[170.0, 175.0, np.nan],
+                                              [-179.0, 178.0, -175.0],
+                                              [0.0, 10.0, 20.0]]))
+        lats = np.ma.masked_array(np.array([[10.0, 11.0, 12.0],
+                                            [13.0, 14.0, 95.0],
+                                            [-5.0, -6.0, -7.0]]))
+
+        for chunk_size in (1, 3, 1000):
+            scan = tig.scan_coordinates(lons, lats, chunk_size=chunk_size)
+            self.assertEqual((scan.min_lon, scan.max_lon), (-179.0, 178.0))
+            self.assertEqual((scan.min_lat, scan.max_lat), (-7.0, 95.0))
+            self.assertEqual(scan.valid_pairs, 7)
+            self.assertTrue(scan.crosses_antimeridian)
+
+        scan = tig.scan_coordinates(lons[2:], lats[2:])
+        self.assertFalse(scan.crosses_antimeridian)
+
+        scan = tig.scan_coordinates(np.ma.masked_all((4,)), np.ma.masked_all((4,)))
+        self.assertEqual(scan.valid_pairs, 0)
+
+    def test_fill_swath_with_neighboring_pixel(self):
+        nan = np.nan
+        image = np.array([[nan, nan, nan, nan],
+                          [nan, 1.0, 2.0, nan],
+                          [nan, nan, 3.0, nan],
+                          [nan, nan, nan, nan]])
+        expected = np.array([[nan, 1.0, 1.0, nan],
+                             [1.0, 1.0, 2.0, 2.0],
+                             [nan, 1.0, 3.0, 2.0],
+                             [nan, nan, 3.0, nan]])
+
+        image_gen = tig.TIG.__new__(tig.TIG)
+        filled = image_gen.fill_swath_with_neighboring_pixel(image)
+        np.testing.assert_array_equal(filled, expected)
+        self.assertTrue(np.isnan(image[0, 0]))
+
+        filled = image_gen.fill_swath_with_neighboring_pixel(image, passes=3)
+        self.assertFalse(np.isnan(filled).any())
+
+    def test_vals_to_rgba(self):
+        colormap = tig.load_json_palette(self.palette_dir, 'paletteMedspirationIndexed', True)
+        vals = np.array([-5.0, 0.0, 0.5, 1.0, 2.0, np.nan, -999.0])
+
+        rgba = tig.vals_to_rgba(vals, 0, 1, colormap, no_data=-999)
+        self.assertEqual(rgba.dtype, np.uint8)
+        self.assertEqual(rgba.shape, (7, 4))
+
+        for i, val in enumerate([0.0, 0.0, 0.5, 1.0, 1.0]):
+            expected = [int(round(x * 255)) for x in colormap(val)[:3]]
+            self.assertEqual(list(rgba[i, :3]), expected)
+        np.testing.assert_array_equal(rgba[:, 3], [255, 255, 255, 255, 255, 255, 0])
+
+        rgb = tig.vals_to_rgba(vals, 0, 1, colormap, transparency=False)
+        np.testing.assert_array_equal(rgb, rgba[:, :3])
+
+    def test_palette_cache(self):
+        tig.clear_palette_cache()
+        palette = tig.load_palette(self.palette_dir, 'paletteMedspirationIndexed', True)
+        self.assertEqual(palette.colors.dtype, np.uint8)
+        self.assertEqual(palette.colors.shape[1], 4)
+        np.testing.assert_array_equal(palette.colors[:, 3], 255)
+
+        with mock.patch.object(tig.json, 'loads') as loads:
+            cached = tig.load_palette(self.palette_dir, 'paletteMedspirationIndexed', True)
+            loads.assert_not_called()
+        self.assertIs(cached, palette)
+
+        # The same palette downloaded to another directory is reused, a changed one is parsed again
+        palette_dir = f'{self.output_dir}/palettes'
+        os.makedirs(palette_dir, exist_ok=True)
+        shutil.copy(f'{self.palette_dir}/paletteMedspirationIndexed.json', palette_dir)
+        self.assertIs(tig.load_palette(palette_dir, 'paletteMedspirationIndexed', True), palette)
+        with open(f'{palette_dir}/paletteMedspirationIndexed.json', 'a') as palette_f:
+            palette_f.write('\n')
+        self.assertIsNot(tig.load_palette(palette_dir, 'paletteMedspirationIndexed', True), palette)
+        self.assertEqual(len(tig._palette_cache), 2)
+
+        rgb = tig.load_palette(self.palette_dir, 'paletteMedspirationIndexed', False)
+        np.testing.assert_array_equal(rgb.colors, palette.colors[:, :3])
+        self.assertIs(tig.load_json_palette(self.palette_dir, 'paletteMedspirationIndexed', True), palette.colormap)
+
+    def test_write_indexed_png(self):
+        colormap = tig.load_json_palette(self.palette_dir, 'paletteMedspirationIndexed', True)
+        vals = np.linspace(-1.5, 1.5, 60).reshape(6, 10)
+        vals[2, 3:7] = np.nan
+        os.makedirs(self.output_dir, exist_ok=True)
+        rgba_file = f'{self.output_dir}/rgba.png'
+        indexed_file = f'{self.output_dir}/indexed.png'
+        plt.imsave(rgba_file, vals, vmin=-1, vmax=1, cmap=colormap, format='png')
+        self.assertTrue(tig.write_indexed_png(indexed_file, vals, -1.0, 1.0, colormap))
+
+        indexed = Image.open(indexed_file)
+        self.assertEqual(indexed.mode, 'P')
+        np.testing.assert_array_equal(np.asarray(indexed.convert('RGBA')),
+                                      np.asarray(Image.open(rgba_file).convert('RGBA')))
+
+    def test_fit_bias_segments(self):
+        rng = np.random.default_rng(0)
+        distance = np.tile(np.linspace(-60e3, 60e3, 40), (300, 1))
+        ssh = 0.05 + 2e-6*distance + 3e-11*distance**2 + rng.normal(0, 0.01, distance.shape)
+        ssh[rng.random(ssh.shape) < 0.05] = np.nan
+
+        # The cross-track polynomial is removed from each side
+        anomaly = tig.fit_bias(ssh, distance)
+        self.assertTrue(np.array_equal(np.isnan(anomaly), np.isnan(ssh)))
+        self.assertLess(np.nanstd(anomaly), 0.011)
+        self.assertLess(abs(np.nanmean(anomaly)), 1e-3)
+
+        # Fitting segments together gives the same result as fitting each one
+        segments = tig.fit_bias_segments([ssh[:200], ssh[150:]], [distance[:200], distance[150:]])
+        np.testing.assert_allclose(segments[0], tig.fit_bias(ssh[:200], distance[:200]), atol=1e-9)
+        np.testing.assert_allclose(segments[1], tig.fit_bias(ssh[150:], distance[150:]), atol=1e-9)
+
+    def test_fit_along_track_polynomial(self):
+        y = np.arange(500)[:, np.newaxis]*np.ones((500, 3))
+        din = 1.0 + 1e-3*y - 2e-6*y**2 + 1e-9*y**3 + 1e-12*y**4
+        din[::7] = np.nan
+
+        anomaly = tig.fit_along_track_polynomial(y, din)
+        np.testing.assert_allclose(anomaly[~np.isnan(din)], 0, atol=1e-9)
+
+    def test_detrend_swath(self):
+        rng = np.random.default_rng(1)
+        distance = np.tile(np.linspace(-70e3, 70e3, 30), (330, 1))
+        data = 0.1*np.sin(np.arange(330)/50)[:, np.newaxis] + 3e-11*distance**2 + rng.normal(0, 0.01, distance.shape)
+
+        detrended, in_window = tig.detrend_swath(data, distance, segments=6, window=[10e3, 60e3])
+        inside = (np.abs(distance) > 10e3) & (np.abs(distance) < 60e3)
+        self.assertTrue(np.array_equal(in_window, inside))
+        self.assertTrue(np.isnan(detrended[~inside]).all())
+        # Segments follow the along-track variation better than one fit of the whole swath
+        single, _ = tig.detrend_swath(data, distance, segments=1, window=[10e3, 60e3])
+        self.assertLess(np.nanstd(detrended), np.nanstd(single)/2)
+
+        # Segments fit in worker threads give the same result
+        threaded, _ = tig.detrend_swath(data, distance, segments=6, window=[10e3, 60e3], workers=4)
+        np.testing.assert_allclose(threaded, detrended, atol=1e-9)
+
+        # SWOT expert ssha_karin_2 is one configuration of the detrending
+        self.assertEqual(tig.get_detrend_config({'id': 'ssha_karin_2', 'is_swot_expert': True}), tig.SWOT_EXPERT_DETREND)
+        self.assertEqual(tig.get_detrend_config({'id': 'ssha', 'detrend': True}), {})
+        self.assertIsNone(tig.get_detrend_config({'id': 'ssha'}))
+
+    def test_aggregate_pixels(self):
+        lut = np.array([2, 0, 2, 2, 3, 0])
+        values = np.array([1.0, 5.0, 3.0, 2.0, -1.0, 4.0])
+
+        expected = {
+            'mean': [4.5, -99, 2.0, -1.0, -99],
+            'min': [4.0, -99, 1.0, -1.0, -99],
+            'max': [5.0, -99, 3.0, -1.0, -99],
+            'count': [2, -99, 3, 1, -99],
+            'last': [4.0, -99, 2.0, -1.0, -99],
+        }
+        for mode, output in expected.items():
+            accumulator = tig.PixelAccumulator(5, mode, -99)
+            accumulator.add(lut, values)
+            np.testing.assert_array_equal(accumulator.result(), output, err_msg=mode)
+
+        with self.assertRaises(ValueError):
+            tig.PixelAccumulator(5, 'median', -99)
+
+    def test_image_levels(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/levels'
+
+        image_gen = tig.TIG(input_file, output_dir, config_file, self.palette_dir)
+        with mock.patch.object(image_gen, 'get_lut', wraps=image_gen.get_lut) as get_lut:
+            images = image_gen.generate_images(granule_id='granule', levels=[2, 1])
+
+        # The data is gridded once and each level is reduced from it
+        self.assertEqual(get_lut.call_count, 1)
+        self.assertEqual([os.path.basename(image['image_file']) for image in images],
+                         ['granule.data_01.ku.ssha.png', 'granule.data_01.ku.ssha.ppd2.png', 'granule.data_01.ku.ssha.ppd1.png'])
+        full, half, quarter = (Image.open(image['image_file']).size for image in images)
+        self.assertEqual(half, (-(-full[0] // 2), -(-full[1] // 2)))
+        self.assertEqual(quarter, (-(-full[0] // 4), -(-full[1] // 4)))
+
+        with self.assertRaises(ValueError):
+            image_gen.generate_images(levels=[3])
+
+        # Levels given to a call don't carry over to the next one
+        images = image_gen.generate_images(granule_id='granule')
+        self.assertEqual([os.path.basename(image['image_file']) for image in images], ['granule.data_01.ku.ssha.png'])
+
+        # Levels of a JSON config may be strings
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        config['image']['levels'] = ['2']
+        images = tig.TIG(input_file, output_dir, config, self.palette_dir).generate_images(granule_id='granule')
+        self.assertEqual([os.path.basename(image['image_file']) for image in images],
+                         ['granule.data_01.ku.ssha.png', 'granule.data_01.ku.ssha.ppd2.png'])
+
+    def test_block_reduce(self):
+        array = np.array([[1.0, 2.0, 5.0],
+                          [np.nan, 3.0, 5.0],
+                          [7.0, 7.0, np.nan]])
+
+        np.testing.assert_array_equal(tig.block_reduce(array, 2), [[2.0, 5.0], [7.0, np.nan]])
+        np.testing.assert_array_equal(tig.block_reduce(array, 2, 'mode'), [[1.0, 5.0], [7.0, np.nan]])
+        np.testing.assert_array_equal(tig.block_reduce(array, 3, 'mode'), [[5.0]])
+        self.assertIs(tig.block_reduce(array, 1), array)
+
+    def test_image_tiles(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/tiles'
+
+        image = tig.TIG(input_file, f'{output_dir}/image', config_file, self.palette_dir).generate_images(world_file=True)[0]
+        full = np.array(Image.open(image['image_file']))
+
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        config['image']['output'] = 'tiles'
+        tiles_config_file = f'{output_dir}/tiles.cfg'
+        os.makedirs(output_dir, exist_ok=True)
+        with open(tiles_config_file, 'w') as config_f:
+            json.dump(config, config_f)
+
+        image_gen = tig.TIG(input_file, f'{output_dir}/tiles', tiles_config_file, self.palette_dir)
+        tiles = image_gen.generate_images(world_file=True)
+        region = image_gen.region
+        pixel_size = ((region.max_lon - region.min_lon)/full.shape[1], (region.max_lat - region.min_lat)/full.shape[0])
+        windows = tig.tile_windows(region.min_lon, region.max_lat, pixel_size, full.shape[:2], config['tiles']['steps'])
+
+        # Only tiles with data are written and together they make up the image
+        self.assertLess(len(tiles), len(windows))
+        tiled = np.zeros_like(full)
+        for x, y, r0, r1, c0, c1 in windows:
+            tile_file = f'{output_dir}/tiles/data_01.ku.ssha.x{x}y{y}.png'
+            if os.path.exists(tile_file):
+                tiled[r0:r1, c0:c1] = np.array(Image.open(tile_file))
+                self.assertTrue(os.path.exists(tile_file.replace('png', 'wld')))
+        np.testing.assert_array_equal(tiled, full)
+
+    def test_tile_windows(self):
+        windows = tig.tile_windows(-50.0, 20.0, (0.5, 0.5), (60, 100), [30, 14])
+
+        self.assertEqual(windows, [
+            (4, 5, 0, 28, 0, 40), (5, 5, 0, 28, 40, 100),
+            (4, 6, 28, 56, 0, 40), (5, 6, 28, 56, 40, 100),
+            (4, 7, 56, 60, 0, 40), (5, 7, 56, 60, 40, 100),
+        ])
+
+    def test_streamed_images_match(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/streamed'
+
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        variable = config['imgVariables'][0]
+        variables = [variable, dict(variable, id='data_01/ku/swh_ocean', aggregation='mean')]
+        config['image']['memory_budget_mb'] = 0.01
+        streamed_config_file = f'{output_dir}/streamed.cfg'
+        os.makedirs(output_dir, exist_ok=True)
+        with open(streamed_config_file, 'w') as config_f:
+            json.dump(config, config_f)
+
+        images = tig.TIG(input_file, f'{output_dir}/full', config_file, self.palette_dir,
+                         variables=variables).generate_images()
+        image_gen = tig.TIG(input_file, f'{output_dir}/streamed', streamed_config_file, self.palette_dir, variables=variables)
+        with mock.patch.object(image_gen, 'iter_lon_lat', wraps=image_gen.iter_lon_lat) as iter_lon_lat:
+            streamed_images = image_gen.generate_images()
+
+        # The coordinates are read in chunks, once for the scan and once per variable
+        self.assertEqual(iter_lon_lat.call_count, 3)
+        for image, streamed_image in zip(images, streamed_images):
+            np.testing.assert_array_equal(np.array(Image.open(image['image_file'])),
+                                          np.array(Image.open(streamed_image['image_file'])))
+
+    def test_streamed_is360(self):
+        output_dir = f'{self.output_dir}/streamed_is360'
+        input_file = f'{output_dir}/swath.nc'
+        os.makedirs(output_dir, exist_ok=True)
+
+        rng = np.random.default_rng(0)
+        lon = np.add.outer(np.linspace(170, 190, 200), np.linspace(0, 2, 20))
+        lat = np.add.outer(np.linspace(-10, 10, 200), np.linspace(0, 1, 20))
+        xr.Dataset({'sst': (('row', 'col'), rng.random(lon.shape)),
+                    'lon': (('row', 'col'), lon), 'lat': (('row', 'col'), lat)}).to_netcdf(
+            input_file, encoding={'lon': {'scale_factor': 1.0, 'add_offset': 0.0}})
+        config = {'image': {'ppd': 4}, 'lonVar': 'lon', 'latVar': 'lat', 'is360': True,
+                  'imgVariables': [{'id': 'sst', 'min': 0, 'max': 1, 'palette': 'paletteMedspirationIndexed'}]}
+        image = tig.TIG(input_file, f'{output_dir}/full', config, self.palette_dir).generate_images()[0]
+
+        # Without is360 in the config, the 0-360 check reads the longitudes in chunks too
+        streamed_config = dict(config, image={'ppd': 4, 'memory_budget_mb': 0.01})
+        del streamed_config['is360']
+        values = xr.DataArray.values
+        longitude_reads = []
+
+        def read_values(data_array):
+            if data_array.name == 'lon':
+                longitude_reads.append(data_array.size)
+            return values.fget(data_array)
+
+        image_gen = tig.TIG(input_file, f'{output_dir}/streamed', streamed_config, self.palette_dir)
+        with mock.patch.object(tig, 'SCAN_CHUNK_SIZE', 1000), \
+                mock.patch.object(xr.DataArray, 'values', property(read_values, values.fset)):
+            streamed_image = image_gen.generate_images()[0]
+
+        self.assertTrue(image_gen._is360[''])
+        self.assertLess(max(longitude_reads), lon.size)
+        np.testing.assert_array_equal(np.array(Image.open(image['image_file'])),
+                                      np.array(Image.open(streamed_image['image_file'])))
+
+    def test_scan_coordinate_chunks(self):
+        lons = np.ma.masked_invalid(np.array([[np.nan, 170.0, 175.0], [178.0, 179.5, -179.0], [10.0, 20.0, 30.0]]))
+        lats = np.ma.masked_invalid(np.array([[0.0, 1.0, 2.0], [3.0, 4.0, 5.0], [6.0, np.nan, 8.0]]))
+
+        scan = tig.scan_coordinates(lons, lats)
+        for chunk_rows in (1, 2):
+            chunks = ((lons[start:start + chunk_rows], lats[start:start + chunk_rows]) for start in range(0, 3, chunk_rows))
+            chunk_scan = tig.scan_coordinate_chunks(chunks)
+            self.assertEqual(vars(chunk_scan), vars(scan))
+
+    def test_scratch_dir_rasters(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/scratch'
+        scratch_dir = f'{output_dir}/scratch'
+
+        array = tig.allocate_array((3, 4), -1.0, scratch_dir=scratch_dir)
+        self.assertIsInstance(array, np.memmap)
+        np.testing.assert_array_equal(array, np.full((3, 4), -1.0))
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+        image = tig.TIG(input_file, f'{output_dir}/memory', config_file, self.palette_dir).generate_images()[0]
+        mapped_image = tig.TIG(input_file, f'{output_dir}/mapped', config_file, self.palette_dir,
+                               scratch_dir=scratch_dir).generate_images()[0]
+        np.testing.assert_array_equal(np.array(Image.open(image['image_file'])),
+                                      np.array(Image.open(mapped_image['image_file'])))
+
+    def test_compact_dtypes(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/dtypes'
+        os.makedirs(output_dir, exist_ok=True)
+
+        with open(config_file) as config_f:
+            config = json.load(config_f)
+        images = {}
+        for dtype in tig.DTYPE_MODES:
+            config['image']['dtype'] = dtype
+            dtype_config_file = f'{output_dir}/{dtype}.cfg'
+            with open(dtype_config_file, 'w') as config_f:
+                json.dump(config, config_f)
+            image_gen = tig.TIG(input_file, f'{output_dir}/{dtype}', dtype_config_file, self.palette_dir)
+            image = image_gen.generate_images()[0]
+            images[dtype] = np.array(Image.open(image['image_file']))
+
+        # Compact values only change colors at the edges of palette bins
+        for dtype in ('float32', 'packed'):
+            self.assertLess((images[dtype] != images['float64']).any(axis=-1).mean(), 1e-3)
+        np.testing.assert_array_equal(images['float32'], images['packed'])
+
+        packed = tig.PackedValues(np.array([10, -5, 32767], dtype=np.int16), 0.5, 1.0, np.array([32767]))
+        np.testing.assert_array_equal(packed.valid(), [True, True, False])
+        np.testing.assert_array_equal(packed.decode(), np.array([6.0, -1.5, np.nan], dtype=np.float32))
+        self.assertEqual(packed.decode(packed.valid()).dtype, np.float32)
+
+    def test_lut_disk_cache(self):
+        config_file = f'{self.config_dir}/SWOT_SIMULATED_L2_NADIR_SSH_ECCO_LLC4320_CALVAL_V1_no_leading_slash.cfg'
+        input_file = f'{self.input_dir}/SWOT_GPR_2PTP003_005_20111115_030538_20111115_035643.nc'
+        output_dir = f'{self.output_dir}/lut_disk_cache'
+        cache_dir = f'{output_dir}/cache'
+
+        images = []
+        with mock.patch.object(grids.BasicGrid, 'calc_lut', autospec=True,
+                               side_effect=grids.BasicGrid.calc_lut) as calc_lut:
+            for run in range(2):
+                image_gen = tig.TIG(input_file, f'{output_dir}/{run}', config_file, self.palette_dir, lut_cache_dir=cache_dir)
+                images.append(image_gen.generate_images()[0]['image_file'])
+
+        # The second granule with the same coordinates loads the look-up table
+        self.assertEqual(calc_lut.call_count, 1)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        np.testing.assert_array_equal(np.array(Image.open(images[0])), np.array(Image.open(images[1])))
+
+        # Least recently used tables are evicted past the size limit
+        cache = tig.LutCache(cache_dir, 2000)
+        for age, key in enumerate(('a', 'b', 'c')):
+            cache.put(key, np.arange(100))
+            os.utime(f'{cache_dir}/{key}.npy', (age, age))
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['b.npy', 'c.npy'])
+        np.testing.assert_array_equal(cache.get('c'), np.arange(100))
+        self.assertIsNone(cache.get('a'))
+
+    def test_rectilinear_grid(self):
+        output_dir = f'{self.output_dir}/rectilinear'
+        input_file = f'{output_dir}/rectilinear.nc'
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Global 1 degree grid with 0 to 360 longitudes and descending latitudes
+        lat = np.arange(89.5, -90, -1)
+        lon = np.arange(0.5, 360, 1)
+        sst = np.repeat(lat[:, np.newaxis], lon.size, axis=1)
+        sst[10] = np.nan
+        xr.Dataset({'sst': (('time', 'lat', 'lon'), sst[np.newaxis])},
+                   coords={'lat': lat, 'lon': lon}).to_netcdf(input_file, encoding={'sst': {'_FillValue': -999.0}})
+        config = {'image': {'ppd': 1}, 'lonVar': 'lon', 'latVar': 'lat', 'is360': True,
+                  'imgVariables': [{'id': 'sst', 'min': -90, 'max': 90, 'palette': 'paletteMedspirationIndexed'}]}
+
+        self.assertEqual(tig.nearest_axis_indices(np.array([30.0, 10.0, 20.0]), [9, 14, 16, 31, 36]).tolist(),
+                         [1, 1, 2, 0, -1])
+        self.assertEqual(tig.nearest_axis_indices(np.arange(-170.0, 180, 20), [-179, 179], period=360).tolist(), [0, 17])
+
+        image_gen = tig.TIG(input_file, output_dir, config, self.palette_dir)
+        self.assertEqual(image_gen.get_rectilinear_dims(), ('lat', 'lon'))
+        with mock.patch.object(image_gen, 'get_lut') as get_lut:
+            image = image_gen.generate_images()[0]
+            get_lut.assert_not_called()
+        self.assertEqual(Image.open(image['image_file']).size, (359, 179))
+
+        # Every pixel takes the value of the nearest grid cell
+        lon_array, lat_array = image_gen.get_lon_lat()
+        output_vals = image_gen.grid_variable(config['imgVariables'][0], '', 'sst', lon_array, lat_array, -999.0,
+                                              image_gen.rows, image_gen.cols).reshape(image_gen.rows, image_gen.cols)
+        expected = np.repeat(np.arange(-89.5, 89, 1)[:, np.newaxis], 359, axis=1)
+        expected[-10] = np.nan
+        np.testing.assert_array_equal(output_vals, expected)
+
+        # Aggregations bin the grid cells onto the image pixels
+        output_vals = image_gen.grid_variable(dict(config['imgVariables'][0], aggregation='count'), '', 'sst',
+                                              lon_array, lat_array, -999.0, image_gen.rows, image_gen.cols)
+        self.assertEqual(np.nansum(output_vals), np.isfinite(sst).sum())
+
+    def test_lazy_imports(self):
+        # Heavy modules are only imported by the code paths that use them
+        modules = subprocess.run([sys.executable, '-c', 'import sys, podaac.tig.tig; print(sorted(sys.modules))'],
+                                 check=True, capture_output=True, text=True).stdout
+        for name in tig.PREWARM_MODULES + ('matplotlib.pyplot',):
+            self.assertNotIn(f"'{name}'", modules)
+
+        timings = tig.prewarm(self.palette_dir, ['paletteMedspirationIndexed'])
+        self.assertEqual(set(timings), set(tig.PREWARM_MODULES))
+        self.assertIn(('paletteMedspirationIndexed', True), {(key[0], key[2]) for key in tig._palette_cache})
+
+    @mock_aws
+    def test_ranged_s3_input(self):
+        output_dir = f'{self.output_dir}/ranged'
+        input_file = f'{output_dir}/ranged.nc'
+        os.makedirs(output_dir, exist_ok=True)
+
+        # The image variable is a small part of the granule
+        lat = np.arange(-9.5, 10)
+        lon = np.arange(-9.5, 10)
+        xr.Dataset({'sst': (('lat', 'lon'), np.add.outer(lat, lon)),
+                    'unused': (('time', 'lat', 'lon'), np.random.default_rng(0).random((2000, lat.size, lon.size)))},
+                   coords={'lat': lat, 'lon': lon}).to_netcdf(input_file, format='NETCDF4')
+        config = {'image': {'ppd': 4}, 'lonVar': 'lon', 'latVar': 'lat', 'is360': False,
+                  'imgVariables': [{'id': 'sst', 'min': -20, 'max': 20, 'palette': 'paletteMedspirationIndexed'}]}
+
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='tig-input')
+        s3_client.upload_file(input_file, 'tig-input', 'granules/ranged.nc')
+
+        image = tig.TIG(input_file, f'{output_dir}/local', config, self.palette_dir).generate_images()[0]
+        with mock.patch.dict(os.environ, {'TIG_RANGE_BLOCK_MB': '0.0625'}):
+            image_gen = tig.TIG('s3://tig-input/granules/ranged.nc', f'{output_dir}/s3', config, self.palette_dir)
+        ranged_image = image_gen.generate_images()[0]
+        np.testing.assert_array_equal(np.array(Image.open(image['image_file'])),
+                                      np.array(Image.open(ranged_image['image_file'])))
+
+        source = image_gen.input_source
+        self.assertEqual(source.size, os.path.getsize(input_file))
+        self.assertLess(source.bytes_fetched, source.size / 4)
+        self.assertLess(source.requests, 20)
+
+        # Reads spanning blocks match the file
+        with open(input_file, 'rb') as local_file:
+            local_file.seek(100000)
+            source.seek(100000)
+            self.assertEqual(source.read(200000), local_file.read(200000))
+        source.seek(-10, os.SEEK_END)
+        self.assertEqual(len(source.read()), 10)
+
+    def test_s3_client_localstack(self):
+        # Ranged reads build their client like the Lambda handler, including LocalStack
+        with mock.patch.dict(os.environ, {'LOCALSTACK_HOST': 'localstack'}):
+            client = tig.get_s3_client(max_pool_connections=4)
+            with mock.patch.object(tig, 'get_s3_client', wraps=tig.get_s3_client) as get_s3_client, \
+                    mock.patch('botocore.client.BaseClient._make_api_call', return_value={'ContentLength': 10}):
+                source = tig.S3RangeFile('s3://tig-input/granule.nc')
+        self.assertEqual(client.meta.endpoint_url, 'http://localstack:4566')
+        self.assertEqual(client.meta.config.max_pool_connections, 4)
+        self.assertEqual(source.client.meta.endpoint_url, 'http://localstack:4566')
+        self.assertEqual(get_s3_client.call_count, 1)
+
 if __name__ == '__main__':
     unittest.main()